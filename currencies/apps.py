@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from django.apps import AppConfig
+from django.core import checks
+from django.db.models.signals import post_delete, post_save
+from django.utils.translation import gettext_lazy as _
+
+
+class CurrenciesConfig(AppConfig):
+    name = 'currencies'
+    verbose_name = _('currencies')
+
+    def ready(self):
+        from . import checks as currency_checks, ratetable
+        from .conf import PRELOAD
+        checks.register(currency_checks.check_settings)
+        checks.register(currency_checks.check_default_currency, checks.Tags.database)
+        # Changes made in the admin or the shell reach the shared rate table too
+        currency = self.get_model('Currency')
+        post_save.connect(ratetable.currency_changed, sender=currency, dispatch_uid='currencies_ratetable')
+        post_delete.connect(ratetable.currency_changed, sender=currency, dispatch_uid='currencies_ratetable')
+        if PRELOAD:
+            self.preload()
+
+    def preload(self):
+        """
+        Move the work of the first conversion in each process to startup:
+        map the rate table, load the snapshot and build the rounding exponents.
+        The database is not queried here
+        """
+        from . import ratetable, snapshot, utils
+        ratetable.get()
+        snapshot.get()
+        utils.build_exponents()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import os
+
+from django.conf import settings
+from django.core import checks
+from django.db import DatabaseError
+
+from . import conf
+
+
+def check_settings(app_configs=None, **kwargs):
+    """Warn about configurations that make conversions slower than they need to be"""
+    errors = []
+    for setting, path in (('CURRENCY_RATE_TABLE', conf.RATE_TABLE), ('CURRENCY_SNAPSHOT', conf.SNAPSHOT)):
+        if path and not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+            errors.append(checks.Warning(
+                "The directory of %s does not exist, so it cannot be published." % setting,
+                hint="Create the directory or change the setting.",
+                obj=path,
+                id='currencies.W002',
+            ))
+    if conf.PRELOAD and not (conf.RATE_TABLE or conf.SNAPSHOT):
+        errors.append(checks.Warning(
+            "CURRENCY_PRELOAD is enabled but neither CURRENCY_RATE_TABLE nor CURRENCY_SNAPSHOT is set, "
+            "so every conversion queries the database.",
+            id='currencies.W003',
+        ))
+    context_processors = [cp for engine in getattr(settings, 'TEMPLATES', [])
+                          for cp in engine.get('OPTIONS', {}).get('context_processors', [])]
+    if ('currencies.context_processors.currencies' in context_processors and
+            getattr(settings, 'SESSION_ENGINE', '') == 'django.contrib.sessions.backends.db'):
+        errors.append(checks.Warning(
+            "The currencies context processor reads the session on every request "
+            "and sessions are stored in the database without a cache.",
+            hint="Set SESSION_ENGINE to 'django.contrib.sessions.backends.cached_db'.",
+            id='currencies.W004',
+        ))
+    return errors
+
+
+def check_default_currency(app_configs=None, databases=None, **kwargs):
+    """Conversions from the default currency fail without one"""
+    from .models import Currency
+    errors = []
+    for alias in databases or []:
+        try:
+            exists = Currency.active.db_manager(alias).filter(is_default=True).exists()
+        except DatabaseError:
+            # Not migrated yet
+            continue
+        if not exists:
+            errors.append(checks.Warning(
+                "There is no active default currency in the %r database." % alias,
+                hint="Mark a currency as default in the admin, or run the currencies command.",
+                obj=Currency,
+                id='currencies.W001',
+            ))
+    return errors
@@ -4,3 +4,30 @@ from django.conf import settings
 
 SESSION_PREFIX = getattr(settings, 'CURRENCY_SESSION_PREFIX', 'session')
 SESSION_KEY = '%s.currency_code' % SESSION_PREFIX
+
+# Dotted paths of currencies.metrics sinks, metrics are disabled if empty
+METRICS_SINKS = getattr(settings, 'CURRENCY_METRICS_SINKS', ())
+
+# Decimal places of the rates calculated when changing base, at most the 10 of Currency.factor
+RATE_PRECISION = getattr(settings, 'CURRENCY_RATE_PRECISION', 10)
+
+# Database aliases used by currencies.routers.CurrencyRouter, no opinion if None
+READ_DATABASE = getattr(settings, 'CURRENCY_READ_DATABASE', None)
+WRITE_DATABASE = getattr(settings, 'CURRENCY_WRITE_DATABASE', None)
+
+# Path of the shared binary rate table published by updatecurrencies, disabled if None
+RATE_TABLE = getattr(settings, 'CURRENCY_RATE_TABLE', None)
+
+# Path of the last-known-good snapshot saved by updatecurrencies, disabled if None
+SNAPSHOT = getattr(settings, 'CURRENCY_SNAPSHOT', None)
+# Seconds to serve the snapshot after a database error before trying the database again
+SNAPSHOT_RETRY = getattr(settings, 'CURRENCY_SNAPSHOT_RETRY', 30)
+# Seconds after which CurrencyForeignKey reads from the database instead of the snapshot, None never.
+# A day by default, so that currencies edited in the admin are not shadowed for good
+SNAPSHOT_MAX_AGE = getattr(settings, 'CURRENCY_SNAPSHOT_MAX_AGE', 24 * 60 * 60)
+
+# Load the rate table, snapshot and rounding exponents when the app is ready
+PRELOAD = getattr(settings, 'CURRENCY_PRELOAD', False)
+
+# Number of recent conversion results cached per process, 0 disables the cache
+CONVERSION_CACHE_SIZE = getattr(settings, 'CURRENCY_CONVERSION_CACHE_SIZE', 1024)
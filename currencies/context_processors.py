@@ -1,21 +1,20 @@
 # -*- coding: utf-8 -*-
 
-from .models import Currency
-from .utils import get_currency_code
+from django.utils.functional import SimpleLazyObject
+
+from .utils import get_currency_code, get_currency, get_active_currencies
 from .conf import SESSION_KEY
+from . import snapshot
 
 
 def currencies(request):
     request.session.setdefault(SESSION_KEY, get_currency_code(False))
-
-    try:
-        currency = Currency.active.get(
-            code__iexact=request.session[SESSION_KEY])
-    except Currency.DoesNotExist:
-        currency = None
+    # Looked up first, a db error makes the rates stale
+    currency = get_currency(request.session[SESSION_KEY])
 
     return {
-        'CURRENCIES': Currency.active.all(),  # get all active currencies
+        'CURRENCIES': SimpleLazyObject(get_active_currencies),  # get all active currencies
         'CURRENCY_CODE': request.session[SESSION_KEY],
         'CURRENCY': currency,  # for backward compatibility
+        'CURRENCY_RATES_STALE': snapshot.stale(),
     }
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Query expressions for converting prices inside the database
+
+    Product.objects.annotate(
+        price_eur=Converted(F('price'), from_field='currency', to='EUR'),
+    ).filter(price_eur__lt=50).order_by('price_eur')
+
+and for updating keys of the currency info in place
+"""
+import json
+from decimal import Decimal as D
+
+from django.db import NotSupportedError
+from django.db.models import (
+    DecimalField, ExpressionWrapper, F, Func, JSONField, OuterRef, Subquery, Value)
+from django.db.models.functions import Abs, Ceil, Sign
+
+from .models import Currency as C
+
+
+def _decimal(expression, decimals=None):
+    return ExpressionWrapper(expression, output_field=DecimalField(
+        max_digits=30, decimal_places=10 if decimals is None else decimals))
+
+
+class Factor(Subquery):
+    """
+    The factor of an active currency, joined on either a code or a field of the
+    outer query, e.g. Factor(code='USD') or Factor(field='currency')
+    No arguments selects the default currency, in line with utils.calculate()
+    """
+    def __init__(self, code=None, field=None):
+        qs = C.active.all()
+        if field is not None:
+            qs = qs.filter(code=OuterRef(field))
+        elif code is not None:
+            qs = qs.filter(code=code)
+        else:
+            qs = qs.filter(is_default=True)
+        super(Factor, self).__init__(qs.order_by().values('factor')[:1],
+            output_field=DecimalField(max_digits=30, decimal_places=10))
+
+
+def _round_up(magnitude, sign, decimals):
+    """
+    ROUND_UP a non-negative magnitude and reapply the sign.
+    The inner ROUND guards backends that compute in floating point (SQLite)
+    from rounding e.g. 110.00000000000001 up to the next unit
+    """
+    scale = Value(D(10) ** decimals, output_field=DecimalField())
+    scaled = Func(_decimal(magnitude * scale), Value(9),
+        function='ROUND', output_field=DecimalField())
+    return _decimal(sign * Ceil(scaled) / scale, decimals)
+
+
+class Converted(Func):
+    """
+    Converts a price expression from one currency to another in the database
+    The source currency is either a field holding the code (e.g. a ForeignKey to Currency),
+    a fixed code, or the default currency if neither are given.
+    Unknown or inactive currencies give NULL
+    """
+    template = '%(expressions)s'
+
+    def __init__(self, expression, to, from_field=None, from_code=None, decimals=2, **extra):
+        if isinstance(expression, str):
+            expression = F(expression)
+        if from_field is None and from_code == to:
+            # Same as utils.convert(), no conversion means no rounding
+            amount = _decimal(expression)
+        else:
+            # Factors are positive so only the magnitude needs converting,
+            # which keeps each joined factor to a single occurrence in the SQL
+            magnitude = expression if decimals is None else Abs(expression)
+            amount = _decimal(
+                _decimal(magnitude * Factor(code=to)) /
+                Factor(code=from_code, field=from_field))
+            if decimals is not None:
+                amount = _round_up(amount, Sign(expression), decimals)
+        extra.setdefault('output_field', amount.output_field)
+        super(Converted, self).__init__(amount, **extra)
+
+
+class JSONSet(Func):
+    """
+    Sets top level keys of a JSONField in the database, leaving the other keys as they are,
+    e.g. .update(info=JSONSet('info', {'RateModified': timestamp}))
+    Check supported(connection) first and otherwise write the whole document
+    """
+    vendors = ('postgresql', 'sqlite', 'mysql')
+
+    def __init__(self, expression, values, **extra):
+        if isinstance(expression, str):
+            expression = F(expression)
+        for key in values:
+            if '"' in key or '\\' in key:
+                raise ValueError("Unsupported info key %r" % key)
+        self.values = values
+        extra.setdefault('output_field', JSONField())
+        super(JSONSet, self).__init__(expression, **extra)
+
+    @classmethod
+    def supported(cls, connection):
+        return connection.vendor in cls.vendors and connection.features.supports_json_field
+
+    def as_sql(self, compiler, connection, **extra_context):
+        raise NotSupportedError("JSONSet is not supported on %s" % connection.vendor)
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        sql, params = compiler.compile(self.source_expressions[0])
+        return "(COALESCE(%s, '{}'::jsonb) || %%s::jsonb)" % sql, list(params) + [json.dumps(self.values)]
+
+    def _json_set(self, compiler, value_sql):
+        sql, params = compiler.compile(self.source_expressions[0])
+        params = list(params)
+        for key, value in self.values.items():
+            params += ['$."%s"' % key, json.dumps(value)]
+        pairs = ', '.join(['%%s, %s' % value_sql] * len(self.values))
+        return "JSON_SET(COALESCE(%s, '{}'), %s)" % (sql, pairs), params
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return self._json_set(compiler, 'JSON(%s)')
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        # JSON_EXTRACT rather than CAST AS JSON for MariaDB
+        return self._json_set(compiler, "JSON_EXTRACT(%s, '$')")
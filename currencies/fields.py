@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import time
+
+from django.db import models, router
+from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor
+
+from .conf import SNAPSHOT_MAX_AGE
+from . import metrics, snapshot
+
+
+def _fresh_snapshot():
+    """The snapshot to resolve currencies from, or None to query the db"""
+    current = snapshot.serving()
+    if current is not None:
+        # The db is down, the snapshot is all there is
+        return current
+    current = snapshot.get()
+    if current is None or SNAPSHOT_MAX_AGE is None:
+        return current
+    if time.time() - current.written.timestamp() > SNAPSHOT_MAX_AGE:
+        return None
+    return current
+
+
+class SnapshotCurrencyDescriptor(ForwardManyToOneDescriptor):
+    """
+    Resolves the related currency from the snapshot, without a query.
+    The info field is deferred and inactive or unknown currencies come from the db
+    """
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        if not self.field.is_cached(instance):
+            currency = self.from_snapshot(instance)
+            if metrics.enabled:
+                metrics.cache('currency_foreignkey', currency is not None)
+            if currency is not None:
+                self.field.set_cached_value(instance, currency)
+        return super(SnapshotCurrencyDescriptor, self).__get__(instance, cls)
+
+    def from_snapshot(self, instance):
+        code = getattr(instance, self.field.attname)
+        if code is None:
+            return None
+        current = _fresh_snapshot()
+        if current is None:
+            return None
+        model = self.field.remote_field.model
+        return current.instance(model, code, router.db_for_read(model, instance=instance))
+
+
+class CurrencyForeignKey(models.ForeignKey):
+    """
+    A ForeignKey to Currency which reads the related currency from the snapshot,
+    see CURRENCY_SNAPSHOT. Migrations see a plain ForeignKey
+    """
+    forward_related_accessor_class = SnapshotCurrencyDescriptor
+
+    def __init__(self, to='currencies.Currency', on_delete=models.PROTECT, **kwargs):
+        super(CurrencyForeignKey, self).__init__(to, on_delete, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(CurrencyForeignKey, self).deconstruct()
+        return name, 'django.db.models.ForeignKey', args, kwargs
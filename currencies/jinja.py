@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Jinja2 support, the equivalent of the currency template tags. Add the extension
+to the Jinja2 backend:
+
+    TEMPLATES = [{
+        'BACKEND': 'django.template.backends.jinja2.Jinja2',
+        'OPTIONS': {'extensions': ['currencies.jinja.CurrencyExtension']},
+    }]
+
+The conversions go through the same Converter as the Django tags, so they share
+the rate table, snapshot, rounding exponents and conversion cache.
+"""
+from django.utils.functional import cached_property
+from jinja2 import pass_context
+from jinja2.ext import Extension
+
+from .models import Currency
+from .utils import (
+    get_currency_code, get_currency, get_active_currencies, currency_cache_key as cache_key,
+    request_converter, Converter)
+from . import metrics, snapshot
+
+
+def get_converter(context):
+    """The converter shared by the currency filters and globals during one render, or of the request"""
+    try:
+        return context._currency_converter
+    except AttributeError:
+        converter = context._currency_converter = request_converter() or Converter()
+        return converter
+
+
+@pass_context
+def currency(context, price, code, decimals=2):
+    """{{ price|currency('USD') }} converts a price from the default currency"""
+    with metrics.queries('currency'):
+        return get_converter(context).convert(price, code, decimals=decimals)
+
+
+@pass_context
+def convert(context, amount, from_code, to_code, decimals=2):
+    """{{ convert(price, 'EUR', 'USD') }} converts an amount between two currencies"""
+    with metrics.queries('currency'):
+        return get_converter(context).convert(amount, to_code, from_code, decimals)
+
+
+@pass_context
+def currency_cache_key(context, code=None, *codes):
+    """
+    {{ currency_cache_key(code) }} is a fragment cache key which changes only with the rate of the
+    currency, CURRENCY_CODE of the context or the currency of the request by default, see the tag
+    """
+    if code is None:
+        code = context.get('CURRENCY_CODE') or get_currency_code(context.get('request'))
+    with metrics.queries('currency_cache_key'):
+        try:
+            return cache_key(code, *codes, converter=get_converter(context))
+        except Currency.DoesNotExist:
+            return '%s.none' % code
+
+
+class CurrencyContext(object):
+    """The variables of the currencies context processor, evaluated when first used"""
+
+    def __init__(self, request):
+        self.request = request
+
+    @cached_property
+    def CURRENCIES(self):
+        return get_active_currencies()
+
+    @cached_property
+    def CURRENCY_CODE(self):
+        return get_currency_code(self.request)
+
+    @cached_property
+    def CURRENCY(self):
+        return get_currency(self.CURRENCY_CODE)
+
+    @property
+    def CURRENCY_RATES_STALE(self):
+        return snapshot.stale()
+
+
+@pass_context
+def currency_context(context, request=None):
+    """{% set currencies = currency_context() %} instead of the context processor"""
+    return CurrencyContext(request or context.get('request'))
+
+
+class CurrencyExtension(Extension):
+    """Adds the currency filter and the convert, currency_context and currency_cache_key globals"""
+
+    def __init__(self, environment):
+        super(CurrencyExtension, self).__init__(environment)
+        environment.filters['currency'] = currency
+        environment.globals['convert'] = convert
+        environment.globals['currency_context'] = currency_context
+        environment.globals['currency_cache_key'] = currency_cache_key
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import threading
+from collections import OrderedDict
+
+from . import metrics
+
+
+class LRUCache(object):
+    """A bounded, thread-safe least recently used mapping with hit and miss counts"""
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """The cached value or None. Unhashable keys are misses"""
+        if self.maxsize <= 0:
+            return None
+        try:
+            with self._lock:
+                value = self._data[key]
+                self._data.move_to_end(key)
+                self.hits += 1
+        except (KeyError, TypeError):
+            with self._lock:
+                self.misses += 1
+            value = None
+        if metrics.enabled:
+            metrics.cache(self.name, value is not None)
+        return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        try:
+            with self._lock:
+                self._data[key] = value
+                self._data.move_to_end(key)
+                if len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+        except TypeError:
+            pass
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        """Returns a dict of the hits, misses, hit_rate, size and maxsize"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+            }
@@ -5,14 +5,25 @@ if sys.version_info[0] < 3:
 import os
 import json
 import logging
-from decimal import Decimal
+from decimal import Decimal, localcontext
+
+from ... import metrics
+from ...conf import RATE_PRECISION
+
+# Enough significant digits for a factor of 30 digits to be exact before rounding
+_CONTEXT_PREC = 60
 
 class BaseHandler(object):
     """
     Base Currency Handler implements helpers:
     _dir
     log()
+    phase(name)
+    supports(capability)
     get_currencysymbol(code) - should be overridden
+    get_ratefactors(base, codes) - adapter for protocol 1 handlers, should be overridden
+    get_bulk_metadata(codes) - adapter for the per code methods, should be overridden
+    rebase(rates, current_base, new_base, precision=None)
     ratechangebase(Decimal, current_base, new_base)
 
     Public API required:
@@ -21,14 +32,24 @@ class BaseHandler(object):
     get_allcurrencycodes()
     get_currencyname(code)
 
-    Optional - do not implement:
-    get_info(code):
-    get_ratefactor(base, code)
-    get_ratetimestamp(base, code)
+    Optional - declare in capabilities (protocol 2) or do not implement (protocol 1):
+    get_info(code): 'info'
+    get_ratefactor(base, code): 'rates'
+    get_ratetimestamp(base, code): 'timestamps'
     """
     # For caching downloaded currency data
     _dir = os.path.dirname(os.path.abspath(__file__))
 
+    # Protocol 2 handlers declare their optional features explicitly and
+    # implement the bulk methods, protocol 1 handlers are adapted
+    protocol = 1
+    capabilities = frozenset()
+    _protocol1_methods = {
+        'info': 'get_info',
+        'rates': 'get_ratefactor',
+        'timestamps': 'get_ratetimestamp',
+    }
+
     def __init__(self, log_func):
         """
         Save the logging function with signature:
@@ -36,25 +57,111 @@ class BaseHandler(object):
         """
         self.log = log_func
 
+    # Set by the commands when timing phases
+    timings = None
+    def phase(self, name):
+        """
+        Context manager around a phase of work on the source data: 'fetch' or 'parse'
+        Observed by metrics and the command --timings option
+        """
+        timer = metrics.timer('currencies_source_%s_seconds' % name, source=self.name)
+        if self.timings is None:
+            return timer
+        return self.timings.phase(name, timer)
+
+    def supports(self, capability):
+        """Whether the source provides the optional 'info', 'rates' or 'timestamps'"""
+        if self.protocol >= 2:
+            return capability in self.capabilities
+        return callable(getattr(self, self._protocol1_methods[capability], None))
+
+    def get_ratefactors(self, base, codes):
+        """
+        Return {code: (Decimal factor, timestamp or None)} of the codes found on the source,
+        with the factor of 'code' compared to 1 'base' unit
+        This adapts the per code methods of protocol 1 handlers, skipping the codes raising RuntimeError
+        """
+        timestamps = self.supports('timestamps')
+        ratefactors = {}
+        for code in codes:
+            try:
+                factor = self.get_ratefactor(base, code)
+            except RuntimeError as e:
+                self.log(logging.ERROR, str(e))
+                continue
+            ratefactors[code] = (factor, self.get_ratetimestamp(base, code) if timestamps else None)
+        return ratefactors
+
+    def get_bulk_metadata(self, codes):
+        """
+        Return {code: {'name': str, 'symbol': str or None, 'info': dict}} of the codes found on the source
+        This adapts the per code methods, sources holding all their data should override it with a single pass
+        """
+        info = self.supports('info')
+        metadata = {}
+        for code in codes:
+            metadata[code] = {
+                'name': self.get_currencyname(code),
+                'symbol': self.get_currencysymbol(code),
+                'info': self.get_info(code) if info else {},
+            }
+        return metadata
+
     _symbols = None
     def get_currencysymbol(self, code):
         """Retrieve the currency symbol from the local file"""
+        if metrics.enabled:
+            metrics.cache('symbols', bool(self._symbols))
         if not self._symbols:
             symbolpath = os.path.join(self._dir, 'currencies.json')
             with open(symbolpath, encoding='utf8') as df:
                 self._symbols = json.load(df)
         return self._symbols.get(code)
 
+    _reciprocals = None
+    def _reciprocal(self, current_base, new_base, new_base_rate):
+        """Helper caching the single division of a change of base"""
+        key = (current_base, new_base, new_base_rate)
+        if self._reciprocals is None:
+            self._reciprocals = {}
+        if key not in self._reciprocals:
+            self.log(logging.WARNING, "CurrencyHandler: changing base ourselves")
+            with localcontext() as ctx:
+                ctx.prec = _CONTEXT_PREC
+                self._reciprocals[key] = Decimal(1) / new_base_rate
+        return self._reciprocals[key]
+
+    def rebase(self, rates, current_base, new_base, precision=None):
+        """
+        Return a new {code: Decimal} of all the rates changed from current_base to new_base in one pass
+        Each rate is rounded once, ROUND_HALF_EVEN to precision decimal places (CURRENCY_RATE_PRECISION)
+        """
+        if current_base in rates and Decimal(1) != rates[current_base]:
+            raise RuntimeError("CurrencyHandler: current baserate: %s not 1" % current_base)
+        if current_base == new_base:
+            multiplier = Decimal(1)
+        else:
+            try:
+                multiplier = self._reciprocal(current_base, new_base, Decimal(rates[new_base]))
+            except KeyError:
+                raise RuntimeError("CurrencyHandler: new base %s not found" % new_base)
+        exponent = Decimal(1).scaleb(-(RATE_PRECISION if precision is None else precision))
+        with localcontext() as ctx:
+            ctx.prec = _CONTEXT_PREC
+            return dict((code, (Decimal(rate) * multiplier).quantize(exponent)) for code, rate in rates.items())
+
     _multiplier = None
     def ratechangebase(self, ratefactor, current_base, new_base):
         """
-        Local helper function for changing currency base, returns new rate in new base
-        Defaults to ROUND_HALF_EVEN
+        Local helper function for changing the base of one rate, returns new rate in new base
+        Rounded like rebase(), which should be preferred for more than one rate
         """
         if self._multiplier is None:
-            self.log(logging.WARNING, "CurrencyHandler: changing base ourselves")
             # Check the current base is 1
             if Decimal(1) != self.get_ratefactor(current_base, current_base):
                 raise RuntimeError("CurrencyHandler: current baserate: %s not 1" % current_base)
-            self._multiplier = Decimal(1) / self.get_ratefactor(current_base, new_base)
-        return (ratefactor * self._multiplier).quantize(Decimal(".0001"))
+            self._multiplier = self._reciprocal(
+                current_base, new_base, self.get_ratefactor(current_base, new_base))
+        with localcontext() as ctx:
+            ctx.prec = _CONTEXT_PREC
+            return (ratefactor * self._multiplier).quantize(Decimal(1).scaleb(-RATE_PRECISION))
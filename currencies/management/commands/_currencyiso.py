@@ -19,8 +19,11 @@ class CurrencyHandler(BaseHandler):
     get_allcurrencycodes()
     get_currencyname(code)
     get_info(code)
+    get_bulk_metadata(codes)
     """
     name = 'currency-iso.org'
+    protocol = 2
+    capabilities = frozenset(['info'])
     endpoint = 'http://www.currency-iso.org/dam/downloads/lists/list_one.xml'
 
     _cached_currency_file = os.path.join(BaseHandler._dir, '_currencyiso.xml')
@@ -38,7 +41,8 @@ class CurrencyHandler(BaseHandler):
     def get_currencies(self):
         """Downloads xml currency data or if not available tries to use cached file copy"""
         try:
-            resp = get(self.endpoint)
+            with self.phase('fetch'):
+                resp = get(self.endpoint)
             resp.raise_for_status()
         except exceptions.RequestException as e:
             self.log(logging.ERROR, "%s: Problem whilst contacting endpoint:\n%s", self.name, e)
@@ -47,7 +51,8 @@ class CurrencyHandler(BaseHandler):
                 fd.write(resp.content)
 
         try:
-            root = ET.parse(self._cached_currency_file).getroot()
+            with self.phase('parse'):
+                root = ET.parse(self._cached_currency_file).getroot()
         except FileNotFoundError as e:
             raise RuntimeError("%s: XML not found at endpoint or as cached file:\n%s" % (self.name, e))
 
@@ -106,7 +111,11 @@ class CurrencyHandler(BaseHandler):
 
     def get_info(self, code):
         """Return a dict of information about the currency"""
-        for i, currency in enumerate(self.get_currency(code)):
+        return self._info(self.get_currency(code))
+
+    def _info(self, currencies):
+        """Helper function building the info from the currency elements of one code"""
+        for i, currency in enumerate(currencies):
             if i == 0:
                 try:
                     exp = int(currency.find('CcyMnrUnts').text)
@@ -125,3 +134,24 @@ class CurrencyHandler(BaseHandler):
             if ctry_name:
                 info['CountryNames'] += [ctry_name]
         return info
+
+    def get_bulk_metadata(self, codes):
+        """Return {code: {'name', 'symbol', 'info'}} of the codes found, in one pass over the XML"""
+        codes = set(codes)
+        entries = {}
+        for currency in self.currencies[0]:
+            try:
+                code = currency.find('Ccy').text
+            except AttributeError:
+                continue
+            if code in codes:
+                entries.setdefault(code, []).append(currency)
+
+        metadata = {}
+        for code, currencies in entries.items():
+            metadata[code] = {
+                'name': currencies[0].find('CcyNm').text,
+                'symbol': self.get_currencysymbol(code),
+                'info': self._info(currencies),
+            }
+        return metadata
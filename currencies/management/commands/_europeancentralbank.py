@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+import os
+import logging
+from xml.etree import ElementTree as ET
+from requests import get, exceptions
+from decimal import Decimal
+from datetime import datetime
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from ._currencyhandler import BaseHandler
+
+
+CUBE = '{http://www.ecb.int/vocabulary/2002-08-01/eurofxref}Cube'
+
+# The feed provides no names, these are the ECB's names for current and past reference currencies
+NAMES = {
+    'EUR': 'Euro',
+    'USD': 'US dollar',
+    'JPY': 'Japanese yen',
+    'BGN': 'Bulgarian lev',
+    'CYP': 'Cyprus pound',
+    'CZK': 'Czech koruna',
+    'DKK': 'Danish krone',
+    'EEK': 'Estonian kroon',
+    'GBP': 'Pound sterling',
+    'HUF': 'Hungarian forint',
+    'LTL': 'Lithuanian litas',
+    'LVL': 'Latvian lats',
+    'MTL': 'Maltese lira',
+    'PLN': 'Polish zloty',
+    'ROL': 'Romanian leu (old)',
+    'RON': 'Romanian leu',
+    'SEK': 'Swedish krona',
+    'SIT': 'Slovenian tolar',
+    'SKK': 'Slovak koruna',
+    'CHF': 'Swiss franc',
+    'ISK': 'Icelandic krona',
+    'NOK': 'Norwegian krone',
+    'HRK': 'Croatian kuna',
+    'RUB': 'Russian rouble',
+    'TRL': 'Turkish lira (old)',
+    'TRY': 'Turkish lira',
+    'AUD': 'Australian dollar',
+    'BRL': 'Brazilian real',
+    'CAD': 'Canadian dollar',
+    'CNY': 'Chinese yuan renminbi',
+    'HKD': 'Hong Kong dollar',
+    'IDR': 'Indonesian rupiah',
+    'ILS': 'Israeli shekel',
+    'INR': 'Indian rupee',
+    'KRW': 'South Korean won',
+    'MXN': 'Mexican peso',
+    'MYR': 'Malaysian ringgit',
+    'NZD': 'New Zealand dollar',
+    'PHP': 'Philippine peso',
+    'SGD': 'Singapore dollar',
+    'THB': 'Thai baht',
+    'ZAR': 'South African rand',
+}
+
+
+class CurrencyHandler(BaseHandler):
+    """
+    Currency Handler implements public API:
+    name
+    endpoint
+    get_allcurrencycodes()
+    get_currencyname(code)
+    get_ratetimestamp(base, code)
+    get_ratefactor(base, code)
+    get_ratefactors(base, codes)
+    iter_rates()
+    """
+    name = 'European Central Bank'
+    base = 'EUR'
+    protocol = 2
+    capabilities = frozenset(['rates', 'timestamps'])
+
+    # Select with the CURRENCY_ECB_FEED setting
+    feeds = {
+        'daily': 'https://www.ecb.europa.eu/stats/eurofxref/eurofxref-daily.xml',
+        '90d': 'https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist-90d.xml',
+        'hist': 'https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist.xml',
+    }
+    endpoint = feeds['daily']
+
+    _cached_currency_file = os.path.join(BaseHandler._dir, '_europeancentralbank.xml')
+    _chunk_size = 64 * 1024
+
+    def __init__(self, *args):
+        """Override the init to select the feed"""
+        feed = getattr(settings, 'CURRENCY_ECB_FEED', 'daily')
+        if feed not in self.feeds:
+            raise ImproperlyConfigured(
+                "The 'CURRENCY_ECB_FEED' setting must be one of %s" % ', '.join(sorted(self.feeds)))
+        if feed != 'daily':
+            self.endpoint = self.feeds[feed]
+            self._cached_currency_file = os.path.join(self._dir, '_europeancentralbank-%s.xml' % feed)
+        super(CurrencyHandler, self).__init__(*args)
+
+    _feed = None
+    def get_feed(self):
+        """
+        Streams the feed to the cached file once, or falls back to the cached copy
+        The history feed runs to megabytes, so it is never held in memory
+        """
+        if self._feed:
+            return self._feed
+        try:
+            with self.phase('fetch'):
+                resp = get(self.endpoint, stream=True)
+                resp.raise_for_status()
+                tmpfile = self._cached_currency_file + '.tmp'
+                size = 0
+                with open(tmpfile, 'wb') as fd:
+                    for chunk in resp.iter_content(chunk_size=self._chunk_size):
+                        size += len(chunk)
+                        fd.write(chunk)
+                # Never replace a good cached copy with an empty download
+                if size:
+                    os.replace(tmpfile, self._cached_currency_file)
+                else:
+                    os.remove(tmpfile)
+        except exceptions.RequestException as e:
+            self.log(logging.ERROR, "%s: Problem whilst contacting endpoint:\n%s", self.name, e)
+
+        if not os.path.exists(self._cached_currency_file):
+            raise RuntimeError("%s: XML not found at endpoint or as cached file:\n%s" % (
+                self.name, self._cached_currency_file))
+        self._feed = self._cached_currency_file
+        return self._feed
+
+    def iter_rates(self):
+        """
+        Yields (datetime, code, Decimal rate) for every day of the feed, newest first
+        Parsed with iterparse and each day is discarded once yielded so memory stays constant,
+        suitable for bulk inserting the full history in chunks
+        """
+        days = None
+        for event, elem in ET.iterparse(self.get_feed(), events=('start', 'end')):
+            if elem.tag != CUBE:
+                continue
+            if 'time' not in elem.attrib:
+                if event == 'start':
+                    # The outer Cube which holds one Cube per day
+                    days = days if days is not None else elem
+                continue
+            if event == 'end':
+                day = datetime.strptime(elem.get('time'), '%Y-%m-%d')
+                rates = [(cube.get('currency'), Decimal(cube.get('rate'))) for cube in elem]
+                elem.clear()
+                if days is not None:
+                    days.remove(elem)
+                for code, rate in rates:
+                    yield day, code, rate
+
+    _rates = None
+    _date = None
+    @property
+    def rates(self):
+        """The rates of the most recent day in the feed"""
+        if self._rates is None:
+            rates = {}
+            for day, code, rate in self.iter_rates():
+                if self._date is None:
+                    self._date = day
+                elif day != self._date:
+                    break
+                rates[code] = rate
+            if not rates:
+                raise RuntimeError("%s: no rates found in %s" % (self.name, self.get_feed()))
+            rates[self.base] = Decimal(1)
+            self._rates = rates
+        return self._rates
+
+    def get_allcurrencycodes(self):
+        """Return an iterable of 3 character ISO 4217 currency codes"""
+        return self.rates.keys()
+
+    def get_currencyname(self, code):
+        """Return the currency name from the code"""
+        return NAMES.get(code)
+
+    def get_ratetimestamp(self, base, code):
+        """Return rate timestamp as a datetime/date or None"""
+        self.rates  # parses the feed
+        return self._date
+
+    def get_ratefactor(self, base, code):
+        """Return the Decimal currency exchange rate factor of 'code' compared to 1 'base' unit, or RuntimeError"""
+        try:
+            ratefactor = self.rates[code]
+        except KeyError:
+            raise RuntimeError("%s: %s not found" % (self.name, code))
+
+        if base == self.base:
+            return ratefactor
+        else:
+            return self.ratechangebase(ratefactor, self.base, base)
+
+    def get_ratefactors(self, base, codes):
+        """Return {code: (Decimal factor, timestamp or None)} of the codes found on the latest day"""
+        rates = self.rebase(self.rates, self.base, base)
+        return dict((code, (rates[code], self._date)) for code in codes if code in rates)
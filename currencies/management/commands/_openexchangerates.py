@@ -16,8 +16,11 @@ class CurrencyHandler(BaseHandler):
     get_currencyname(code)
     get_ratetimestamp(base, code)
     get_ratefactor(base, code)
+    get_ratefactors(base, codes)
     """
     name = 'Open Exchange Rates'
+    protocol = 2
+    capabilities = frozenset(['rates', 'timestamps'])
 
     def __init__(self, *args):
         """Override the init to check for the APP_ID"""
@@ -33,7 +36,8 @@ class CurrencyHandler(BaseHandler):
     @property
     def currencies(self):
         if not self._currencies:
-            self._currencies = self.client.currencies()
+            with self.phase('fetch'):
+                self._currencies = self.client.currencies()
         return self._currencies
 
     def get_allcurrencycodes(self):
@@ -68,11 +72,13 @@ class CurrencyHandler(BaseHandler):
         """
         if not self.rates:
             try:
-                rates = self.client.latest(base=base)
+                with self.phase('fetch'):
+                    rates = self.client.latest(base=base)
             except OpenExchangeRatesClientException as e:
                 base = 'USD'
                 if str(e).startswith('403'):
-                    rates = self.client.latest(base=base)
+                    with self.phase('fetch'):
+                        rates = self.client.latest(base=base)
                 else:
                     raise
             self.check_rates(rates, base)
@@ -81,7 +87,8 @@ class CurrencyHandler(BaseHandler):
         """Return rate timestamp as a datetime/date or None"""
         self.get_latestcurrencyrates(base)
         try:
-            return datetime.fromtimestamp(self.rates["timestamp"])
+            # The client parses every number as a Decimal
+            return datetime.fromtimestamp(int(self.rates["timestamp"]))
         except KeyError:
             return None
 
@@ -97,3 +104,10 @@ class CurrencyHandler(BaseHandler):
             return ratefactor
         else:
             return self.ratechangebase(ratefactor, self.base, base)
+
+    def get_ratefactors(self, base, codes):
+        """Return {code: (Decimal factor, timestamp or None)} of the codes found, from one rates response"""
+        self.get_latestcurrencyrates(base)
+        ratetimestamp = self.get_ratetimestamp(base, None)
+        rates = self.rebase(self.rates["rates"], self.base, base)
+        return dict((code, (rates[code], ratetimestamp)) for code in codes if code in rates)
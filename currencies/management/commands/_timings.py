@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import OrderedDict
+
+from django.db import connections
+
+
+class _Null(object):
+    """No-op phase used when not timing"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+null = _Null()
+
+
+class _Phase(object):
+    def __init__(self, timings, name, inner):
+        self.timings, self.name, self.inner = timings, name, inner
+
+    def __enter__(self):
+        self.timings._switch()
+        self.timings._stack.append(self.name)
+        self.inner.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.inner.__exit__(*exc_info)
+        self.timings._switch()
+        self.timings._stack.pop()
+        return False
+
+
+class Timings(object):
+    """
+    Accumulates the wall time and db queries of the named phases of a command run
+    Time is exclusive: a nested phase pauses the phase around it.
+    Anything outside a phase is charged to 'other'
+    """
+    def __init__(self):
+        self.phases = OrderedDict()
+        self._stack = ['other']
+        self._last = self._start = time.time()
+
+    def _entry(self, name):
+        return self.phases.setdefault(name, {'seconds': 0.0, 'queries': 0})
+
+    def _switch(self):
+        """Charge the time since the last switch to the current phase"""
+        now = time.time()
+        self._entry(self._stack[-1])['seconds'] += now - self._last
+        self._last = now
+
+    def __call__(self, execute, sql, params, many, context):
+        """Database execute wrapper counting queries against the current phase"""
+        self._entry(self._stack[-1])['queries'] += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self._wrappers = [conn.execute_wrapper(self) for conn in connections.all()]
+        for wrapper in self._wrappers:
+            wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        for wrapper in reversed(self._wrappers):
+            wrapper.__exit__(*exc_info)
+        self._switch()
+        self.total = self._last - self._start
+        return False
+
+    def phase(self, name, inner=null):
+        """Context manager timing a phase, optionally around another context manager"""
+        return _Phase(self, name, inner)
+
+    def summary(self, **extra):
+        """Returns a dict suitable for a machine-readable summary"""
+        summary = dict(extra)
+        summary['seconds'] = round(self.total, 6)
+        summary['phases'] = OrderedDict(
+            (name, {'seconds': round(entry['seconds'], 6), 'queries': entry['queries']})
+            for name, entry in self.phases.items())
+        return summary
@@ -2,7 +2,6 @@
 import sys, re, json, os
 import logging
 # requires beautifulsoup4 and requests
-from bs4 import BeautifulSoup as BS4
 from requests import get, exceptions
 from decimal import Decimal
 from datetime import datetime
@@ -22,6 +21,7 @@ class CurrencyHandler(BaseHandler):
     get_currencyname(code)
     get_currencysymbol(code)
     get_info(code)
+    get_bulk_metadata(codes)
     get_ratetimestamp(base, code)
     get_ratefactor(base, code)
     """
@@ -67,12 +67,15 @@ class CurrencyHandler(BaseHandler):
         start = r'YAHOO\.Finance\.CurrencyConverter\.addCurrencies\('
         _json = r'\[[^\]]*\]'
         try:
-            resp = get(self.currencies_url)
+            with self.phase('fetch'):
+                resp = get(self.currencies_url)
             resp.raise_for_status()
         except exceptions.RequestException as e:
             self.log(logging.ERROR, "%s Deprecated: API withdrawn in February 2018:\n%s", self.name, e)
         else:
             # Find the javascript that contains the json object
+            # bs4 is only imported when there is a page to scrape
+            from bs4 import BeautifulSoup as BS4
             soup = BS4(resp.text, 'html.parser')
             re_start = re.compile(start)
             try:
@@ -90,7 +93,7 @@ class CurrencyHandler(BaseHandler):
 
         # Parse the json file
         try:
-            with open(self._cached_currency_file, 'r') as fd:
+            with open(self._cached_currency_file, 'r') as fd, self.phase('parse'):
                 j = json.load(fd)
         except FileNotFoundError:
             j = None
@@ -102,7 +105,8 @@ class CurrencyHandler(BaseHandler):
     def get_bulkrates(self):
         """Get & format the rates dict"""
         try:
-            resp = get(self.bulk_url)
+            with self.phase('fetch'):
+                resp = get(self.bulk_url)
             resp.raise_for_status()
         except exceptions.RequestException as e:
             raise RuntimeError(e)
@@ -112,7 +116,8 @@ class CurrencyHandler(BaseHandler):
         """Get a single rate, used as fallback"""
         try:
             url = self.onerate_url % (base, code)
-            resp = get(url)
+            with self.phase('fetch'):
+                resp = get(url)
             resp.raise_for_status()
         except exceptions.HTTPError as e:
             self.log(logging.ERROR, "%s: problem with %s:\n%s", self.name, url, e)
@@ -154,7 +159,10 @@ class CurrencyHandler(BaseHandler):
 
     def get_info(self, code):
         """Return a dict of information about the currency"""
-        currency = self.get_currency(code)
+        return self._info(self.get_currency(code))
+
+    def _info(self, currency):
+        """Helper function building the info from a currency dict"""
         info = {}
 
         users = list(filter(None, currency['users'].split(',')))
@@ -170,6 +178,20 @@ class CurrencyHandler(BaseHandler):
 
         return info
 
+    def get_bulk_metadata(self, codes):
+        """Return {code: {'name', 'symbol', 'info'}} of the codes found, in one pass over the currencies"""
+        codes = set(codes)
+        metadata = {}
+        for currency in self.currencies:
+            code = currency['shortname']
+            if code in codes and code not in metadata:
+                metadata[code] = {
+                    'name': currency['longname'],
+                    'symbol': currency['symbol'],
+                    'info': self._info(currency),
+                }
+        return metadata
+
     def get_rate(self, code):
         """
         Helper function to access the rates structure
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import io
+import json
 import logging
 from datetime import datetime
 from collections import OrderedDict
@@ -6,7 +8,11 @@ from importlib import import_module
 from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, router
+from ...expressions import JSONSet
 from ...models import Currency
+from ... import metrics
+from ._timings import Timings, null
 
 
 # The list of available backend currency sources
@@ -15,9 +21,9 @@ sources = OrderedDict([
     ('oxr',     '._openexchangerates'),
     ('yahoo',   '._yahoofinance'),
     ('iso',     '._currencyiso'),
+    ('ecb',     '._europeancentralbank'),
     #TODO:
     #('google', '._googlecalculator.py'),
-    #('ecb', '._europeancentralbank.py'),
 ])
 
 
@@ -43,6 +49,39 @@ class Command(BaseCommand):
             help=   'Selectively import currencies by supplying the currency codes (e.g. USD) one per switch, '
                     'or supply an uppercase settings variable name with an iterable (once only), '
                     'or looks for settings CURRENCIES or SHOP_CURRENCIES.')
+        self.add_database_argument(parser)
+        self.add_profile_arguments(parser)
+
+    def add_database_argument(self, parser):
+        """Add the database command argument"""
+        parser.add_argument('--database', action='store', default=None,
+            help='Nominates the database alias to update, '
+                 'the default is the write database of the currencies models')
+
+    def get_manager(self, option):
+        """Return the Currency manager for the chosen database"""
+        self.database = option or router.db_for_write(Currency)
+        return Currency._default_manager.db_manager(self.database)
+
+    def info_update(self, obj, values):
+        """
+        The update of the info keys: set in place by the database where supported,
+        otherwise the whole document. obj.info is updated either way
+        """
+        obj.info.update(values)
+        if JSONSet.supported(connections[self.database]):
+            return JSONSet('info', values)
+        return obj.info
+
+    def add_profile_arguments(self, parser):
+        """Add the profiling & timing command arguments"""
+        parser.add_argument('--timings', action='store_true', default=False,
+            help='Report the wall time and db queries of the fetch, parse, diff and write phases '
+                 'and finish with a single line JSON summary prefixed by "currencies-timings"')
+        parser.add_argument('--profile', action='store', nargs='?', const='-', default=None,
+            metavar='FILE',
+            help='Profile the run with cProfile and dump the pstats to FILE, '
+                 'or print the top functions if no FILE is supplied')
 
     def get_imports(self, option):
         """
@@ -92,11 +131,61 @@ class Command(BaseCommand):
             else:
                 self.stdout.write(fmsg)
 
+    timings = None
+    def phase(self, name):
+        """Context manager around a phase of the run: 'fetch', 'parse', 'diff' or 'write'"""
+        if self.timings is None:
+            return null
+        return self.timings.phase(name)
+
+    def execute(self, *args, **options):
+        """Times the whole command run per source when metrics are enabled, and profiles on request"""
+        command = self.__module__.rsplit('.', 1)[-1]
+        source = options.get(self._source_param)
+        profile = options.get('profile')
+        self.timings = Timings() if options.get('timings') else None
+
+        profiler = None
+        if profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            with metrics.timer('currencies_command_seconds', command=command, source=source), \
+                    (self.timings or null):
+                return super(Command, self).execute(*args, **options)
+        finally:
+            if profiler:
+                profiler.disable()
+                self.report_profile(profiler, profile)
+            if self.timings:
+                self.report_timings(command=command, source=source)
+
+    def report_profile(self, profiler, path):
+        """Dump the pstats to a file or print the top functions by cumulative time"""
+        if path != '-':
+            profiler.dump_stats(path)
+            self.log(logging.INFO, "Profile written to %s", path)
+            return
+        import pstats
+        buf = io.StringIO()
+        pstats.Stats(profiler, stream=buf).sort_stats('cumulative').print_stats(25)
+        self.stdout.write(buf.getvalue())
+
+    def report_timings(self, **extra):
+        """Log each phase and write the machine-readable summary line"""
+        summary = self.timings.summary(**extra)
+        for name, phase in summary['phases'].items():
+            self.log(logging.INFO, "Phase %s: %.3fs, %d queries", name, phase['seconds'], phase['queries'])
+        self.stdout.write('currencies-timings ' + json.dumps(summary))
+
     def get_handler(self, options):
         """Return the specified handler"""
         # Import the CurrencyHandler and get an instance
         handler_module = import_module(sources[options[self._source_param]], self._package_name)
-        return handler_module.CurrencyHandler(self.log)
+        handler = handler_module.CurrencyHandler(self.log)
+        handler.timings = self.timings
+        return handler
 
     def handle(self, *args, **options):
         """Handle the command"""
@@ -104,6 +193,7 @@ class Command(BaseCommand):
         self.verbosity = int(options.get('verbosity', 1))
         force = options['force']
         imports = self.get_imports(options['import'])
+        manager = self.get_manager(options['database'])
 
         # Import the CurrencyHandler and get an instance
         handler = self.get_handler(options)
@@ -112,46 +202,55 @@ class Command(BaseCommand):
         timestamp = datetime.now().isoformat()
 
         # find available codes
-        if imports:
-            allcodes = set(handler.get_allcurrencycodes())
-            reqcodes = set(imports)
-            available = reqcodes & allcodes
-            unavailable = reqcodes - allcodes
-        else:
-            self.log(logging.WARNING, "Importing all. Some currencies may be out-of-date (MTL) or spurious (XPD)")
-            available = handler.get_allcurrencycodes()
-            unavailable = None
+        with self.phase('parse'):
+            if imports:
+                allcodes = set(handler.get_allcurrencycodes())
+                reqcodes = set(imports)
+                available = reqcodes & allcodes
+                unavailable = reqcodes - allcodes
+            else:
+                self.log(logging.WARNING, "Importing all. Some currencies may be out-of-date (MTL) or spurious (XPD)")
+                available = list(handler.get_allcurrencycodes())
+                unavailable = None
+
+        with self.phase('parse'):
+            metadata = handler.get_bulk_metadata(available)
 
         for code in available:
-            obj, created = Currency._default_manager.get_or_create(code=code)
-            name = handler.get_currencyname(code)
+            with self.phase('diff'):
+                obj, created = manager.get_or_create(code=code)
+            meta = metadata.get(code, {})
+            name = meta.get('name')
             description = "%r (%s)" % (name, code)
             if created or force:
                 kwargs = {}
+                info = {}
                 if created:
                     kwargs['is_active'] = False
                     msg = "Creating %s"
-                    obj.info.update( {'Created': timestamp} )
+                    info['Created'] = timestamp
                 else:
                     msg = "Updating %s"
-                obj.info.update( {'Modified': timestamp} )
+                info['Modified'] = timestamp
 
                 if name:
                     kwargs['name'] = name
 
-                symbol = handler.get_currencysymbol(code)
+                symbol = meta.get('symbol')
                 if symbol:
                     kwargs['symbol'] = symbol
 
-                try:
-                    obj.info.update(handler.get_info(code))
-                except AttributeError:
-                    pass
-
-                kwargs['info'] = obj.info
+                info.update(meta.get('info', {}))
+                kwargs['info'] = self.info_update(obj, info)
+                if 'ISO4217Number' in info:
+                    kwargs['iso_number'] = info['ISO4217Number']
+                if 'ISO4217Exponent' in info:
+                    kwargs['exponent'] = info['ISO4217Exponent']
 
                 self.log(logging.INFO, msg, description)
-                Currency._default_manager.filter(pk=obj.pk).update(**kwargs)
+                with self.phase('write'):
+                    manager.filter(pk=obj.pk).update(**kwargs)
+                metrics.incr('currencies_rows_written_total', command='currencies', source=handler.name)
             else:
                 msg = "Skipping %s"
                 self.log(logging.INFO, msg, description)
@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
 import logging
-from datetime import datetime
-from decimal import Decimal
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation, localcontext
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from .currencies import Command as CurrencyCommand
 from ...models import Currency
+from ...signals import RateChange, rates_updated
+from ...utils import _QueryRates
+from ... import metrics, ratetable, snapshot
 
 
 class Command(CurrencyCommand):
@@ -19,6 +24,8 @@ class Command(CurrencyCommand):
             help=   'Supply the base currency as code or a settings variable name. '
                     'The default is taken from settings CURRENCIES_BASE or SHOP_DEFAULT_CURRENCY, '
                     'or the db, otherwise USD')
+        self.add_database_argument(parser)
+        self.add_profile_arguments(parser)
 
     def get_base(self, option):
         """
@@ -39,18 +46,82 @@ class Command(CurrencyCommand):
                 continue
         return 'USD', False
 
+    def get_threshold(self, code):
+        """
+        Return the change threshold of a currency as (Decimal, relative) or None
+        From the CURRENCY_RATE_THRESHOLDS dict by code, or the global CURRENCY_RATE_THRESHOLD setting.
+        A threshold is an absolute change of factor, or relative if it ends with '%', e.g. '0.05%'
+        """
+        thresholds = getattr(settings, 'CURRENCY_RATE_THRESHOLDS', {})
+        threshold = thresholds.get(code, getattr(settings, 'CURRENCY_RATE_THRESHOLD', None))
+        if threshold is None:
+            return None
+        threshold = str(threshold).strip()
+        relative = threshold.endswith('%')
+        try:
+            value = Decimal(threshold.rstrip('%'))
+        except InvalidOperation:
+            raise ImproperlyConfigured("Invalid currency rate threshold for %s: %r" % (code, threshold))
+        return (value / 100 if relative else value), relative
+
+    def get_max_age(self):
+        """The CURRENCY_RATE_MAX_AGE setting in seconds or as a timedelta, or None"""
+        max_age = getattr(settings, 'CURRENCY_RATE_MAX_AGE', None)
+        if max_age is None or isinstance(max_age, timedelta):
+            return max_age
+        return timedelta(seconds=max_age)
+
+    def is_significant(self, obj, factor):
+        """Whether the change of factor reaches the threshold of the currency"""
+        threshold = self.get_threshold(obj.code)
+        if threshold is None:
+            return True
+        value, relative = threshold
+        change = abs(factor - obj.factor)
+        if relative:
+            if not obj.factor:
+                return True
+            change /= abs(obj.factor)
+        return change >= value
+
+    def quantize(self, factor):
+        """The factor rounded as the Currency.factor column stores it, so it compares equal once written"""
+        field = Currency._meta.get_field('factor')
+        with localcontext() as ctx:
+            ctx.prec = field.max_digits
+            return factor.quantize(Decimal(1).scaleb(-field.decimal_places))
+
+    def is_stale(self, obj, max_age, now):
+        """Whether the rate was last written longer than max_age ago"""
+        if max_age is None:
+            return False
+        modified = parse_datetime(obj.info.get('RateModified', ''))
+        # Written naive or aware depending on USE_TZ at the time
+        return modified is None or self.as_datetime(now) - self.as_datetime(modified) > max_age
+
+    def as_datetime(self, value):
+        """A source timestamp as a datetime for the rate_updated column"""
+        if not isinstance(value, datetime):
+            value = datetime(value.year, value.month, value.day)
+        if settings.USE_TZ and timezone.is_naive(value):
+            return timezone.make_aware(value)
+        if not settings.USE_TZ and timezone.is_aware(value):
+            return timezone.make_naive(value)
+        return value
+
     def handle(self, *args, **options):
         """Handle the command"""
         # get the command arguments
         self.verbosity = int(options.get('verbosity', 1))
         base, base_was_arg = self.get_base(options['base'])
+        manager = self.get_manager(options['database'])
 
         # Import the CurrencyHandler and get an instance
         handler = self.get_handler(options)
 
         # See if the db already has a base currency
         try:
-            db_base_obj = Currency._default_manager.get(is_base=True)
+            db_base_obj = manager.get(is_base=True)
             db_base = db_base_obj.code
         except Currency.DoesNotExist:
             db_base = None
@@ -63,7 +134,7 @@ class Command(CurrencyCommand):
             # see if the argument base currency exists in the db
             try:
                 base_in_db = True
-                base_obj = Currency._default_manager.get(code=base)
+                base_obj = manager.get(code=base)
             except Currency.DoesNotExist:
                 base_in_db = False
                 raise ImproperlyConfigured(
@@ -71,47 +142,86 @@ class Command(CurrencyCommand):
 
         if db_base and base_was_arg and base_in_db and (db_base != base):
             self.log(logging.INFO, "Changing db base currency from %s to %s", db_base, base)
-            db_base_obj.is_base = False
-            db_base_obj.save()
-            base_obj.is_base = True
-            base_obj.save()
+            manager.set_base(base)
         elif (not db_base) and base_in_db:
-            base_obj.is_base = True
-            base_obj.save()
+            manager.set_base(base)
 
         self.log(logging.INFO, "Using %s as base for all currencies", base)
         self.log(logging.INFO, "Getting currency rates from %s", handler.endpoint)
-        timestamp = datetime.now().isoformat()
-
-        obj = None
-        for obj in Currency._default_manager.all():
+        now = datetime.now()
+        timestamp = now.isoformat()
+        max_age = self.get_max_age()
+
+        if not handler.supports('rates'):
+            self.log(logging.CRITICAL, "%s source does not provide currency rate information", handler.name)
+            return
+
+        changes = {}
+        suppressed = 0
+        with self.phase('diff'):
+            currencies = list(manager.all())
+        ratefactors = {}
+        if not currencies:
+            self.log(logging.ERROR, "No currencies found in the db to update; try the currencies command!")
+        else:
             try:
-                rate = handler.get_ratefactor(base, obj.code)
-            except AttributeError:
-                self.log(logging.CRITICAL, "%s source does not provide currency rate information", handler.name)
-                return
+                with self.phase('parse'):
+                    ratefactors = handler.get_ratefactors(base, [obj.code for obj in currencies])
             except RuntimeError as e:
                 self.log(logging.ERROR, str(e))
-                return
+                # The codes were never looked up, none of them is reported as not found
+                currencies = []
 
-            factor = rate.quantize(Decimal(".0001"))
+        for obj in currencies:
+            try:
+                factor, ratetimestamp = ratefactors[obj.code]
+            except KeyError:
+                self.log(logging.INFO, "%s not found in %s, rate untouched", obj.code, handler.name)
+                continue
+            factor = self.quantize(factor)
+
+            if self.is_stale(obj, max_age, now):
+                self.log(logging.DEBUG, "%s rate is stale, refreshing", obj.code)
+            elif obj.factor == factor:
+                continue
+            elif not self.is_significant(obj, factor):
+                self.log(logging.DEBUG, "%s rate change to %s is below the threshold", obj.code, factor)
+                suppressed += 1
+                continue
+
+            kwargs = {'factor': factor, 'rate_source': options[self._source_param]}
+            info = {'RateModified': timestamp}
+            if ratetimestamp:
+                info['RateUpdate'] = ratetimestamp.isoformat()
+                kwargs['rate_updated'] = self.as_datetime(ratetimestamp)
+                update_str = ", source timestamp %s" % ratetimestamp.strftime("%Y-%m-%d %H:%M:%S")
+            else:
+                update_str = ""
+            kwargs['info'] = self.info_update(obj, info)
+
+            self.log(logging.INFO, "Updating %r rate to %s%s", obj.name, factor, update_str)
+
+            with self.phase('write'):
+                manager.filter(pk=obj.pk).update(**kwargs)
+            metrics.incr('currencies_rows_written_total', command='updatecurrencies', source=handler.name)
             if obj.factor != factor:
-                kwargs = {'factor': factor}
-                try:
-                    ratetimestamp = handler.get_ratetimestamp(base, obj.code)
-                except AttributeError:
-                    ratetimestamp = None
-                if ratetimestamp:
-                    obj.info.update( {'RateUpdate': ratetimestamp.isoformat()} )
-                    update_str = ", source timestamp %s" % ratetimestamp.strftime("%Y-%m-%d %H:%M:%S")
-                else:
-                    update_str = ""
-
-                obj.info.update( {'RateModified': timestamp} )
-                kwargs['info'] = obj.info
-
-                self.log(logging.INFO, "Updating %r rate to %s%s", obj.name, factor, update_str)
-
-                Currency._default_manager.filter(pk=obj.pk).update(**kwargs)
-        if not obj:
-            self.log(logging.ERROR, "No currencies found in the db to update; try the currencies command!")
+                changes[obj.code] = RateChange(obj.factor, factor, kwargs.get('rate_updated') or self.as_datetime(now))
+
+        if suppressed:
+            self.log(logging.INFO, "Suppressed %d rate updates below the change threshold", suppressed)
+            metrics.incr('currencies_rows_suppressed_total', suppressed,
+                command='updatecurrencies', source=handler.name)
+
+        with self.phase('write'):
+            table_version = snapshot_version = None
+            if ratetable.RATE_TABLE:
+                table_version = ratetable.write(manager.all())
+                self.log(logging.INFO, "Published rate table version %016x to %s", table_version, ratetable.RATE_TABLE)
+            if snapshot.SNAPSHOT:
+                snapshot_version = snapshot.write(manager.all())
+                self.log(logging.INFO, "Saved snapshot version %s to %s", snapshot_version, snapshot.SNAPSHOT)
+            if changes:
+                rates_updated.send(sender=self.__class__, changes=changes,
+                    version=_QueryRates(manager.filter(is_active=True)).version,
+                    table_version=table_version, snapshot_version=snapshot_version,
+                    source=options[self._source_param], using=self.database)
@@ -1,6 +1,14 @@
 # -*- coding: utf-8 -*-
 
-from django.db import models
+from django.db import models, router, transaction
+
+from . import ratetable
+from .signals import default_changed
+
+
+def send_default_changed(model, code, using):
+    """Send default_changed once the current transaction commits"""
+    transaction.on_commit(lambda: default_changed.send(sender=model, code=code, using=using), using=using)
 
 
 class CurrencyQuerySet(models.QuerySet):
@@ -14,6 +22,34 @@ class CurrencyQuerySet(models.QuerySet):
     def base(self):
         return self.get(is_base=True)
 
+    async def adefault(self):
+        return await self.aget(is_default=True)
+
+    async def abase(self):
+        return await self.aget(is_base=True)
+
+    def set_default(self, code):
+        """Make code the default currency, in one transaction"""
+        self._swap('is_default', code)
+
+    def set_base(self, code):
+        """Make code the base currency, in one transaction. The factors are left to updatecurrencies"""
+        self._swap('is_base', code)
+
+    def _swap(self, flag, code):
+        # The unique constraint allows a single True flag at any time, held by any row
+        # whatever the filters of this queryset, e.g. an inactive one for Currency.active
+        db = self._db or router.db_for_write(self.model)
+        currencies = self.model._default_manager.using(db)
+        with transaction.atomic(using=db):
+            currencies.filter(**{flag: True}).exclude(code=code).update(**{flag: False})
+            if not currencies.filter(code=code).update(**{flag: True, 'is_active': True}):
+                raise self.model.DoesNotExist("Currency %s not found" % code)
+            # Updates send no post_save
+            ratetable.republish(self.model, db)
+            if flag == 'is_default':
+                send_default_changed(self.model, code, db)
+
 
 class CurrencyManager(models.Manager):
 
@@ -25,3 +61,15 @@ class CurrencyManager(models.Manager):
 
     def base(self):
         return self.get_queryset().base()
+
+    async def adefault(self):
+        return await self.get_queryset().adefault()
+
+    async def abase(self):
+        return await self.get_queryset().abase()
+
+    def set_default(self, code):
+        return self.get_queryset().set_default(code)
+
+    def set_base(self, code):
+        return self.get_queryset().set_base(code)
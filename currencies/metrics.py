@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Optional instrumentation of conversions, caches, template tag queries and the
+management commands. Enabled by listing sinks in settings, e.g.
+
+    CURRENCY_METRICS_SINKS = [
+        'currencies.metrics.PrometheusSink',
+        'currencies.metrics.LoggingSink',
+    ]
+
+When no sinks are configured the instrumented code only checks `enabled`
+"""
+import logging
+import threading
+import time
+from calendar import timegm
+
+from django.db import connections
+from django.http import Http404, HttpResponse
+from django.utils.module_loading import import_string
+
+from .conf import METRICS_SINKS
+
+
+logger = logging.getLogger("django.currencies.metrics")
+
+enabled = False
+sinks = []
+
+
+def configure(sink_list):
+    """Set the sinks, given as instances or dotted class paths. An empty list disables metrics"""
+    global enabled, sinks
+    sinks = [import_string(sink)() if isinstance(sink, str) else sink for sink in sink_list]
+    enabled = bool(sinks)
+
+
+def _record(kind, name, value, labels):
+    for sink in sinks:
+        sink.record(kind, name, value, labels)
+
+
+def incr(name, value=1, **labels):
+    """Increment a counter"""
+    if enabled:
+        _record('counter', name, value, labels)
+
+
+def gauge(name, value, **labels):
+    """Set a gauge"""
+    if enabled:
+        _record('gauge', name, value, labels)
+
+
+def observe(name, value, **labels):
+    """Record an observation, e.g. a duration in seconds"""
+    if enabled:
+        _record('summary', name, value, labels)
+
+
+def cache(name, hit):
+    """Record a cache lookup as a hit or a miss"""
+    if enabled:
+        _record('counter', 'currencies_cache_requests_total', 1,
+            {'cache': name, 'result': 'hit' if hit else 'miss'})
+
+
+class _Null(object):
+    """Shared no-op context manager returned while disabled"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_null = _Null()
+
+
+class _Timer(object):
+    def __init__(self, name, labels):
+        self.name, self.labels = name, labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.time() - self.start, **self.labels)
+        return False
+
+
+def timer(name, **labels):
+    """Context manager observing the wall time of its block in seconds"""
+    if not enabled:
+        return _null
+    return _Timer(name, labels)
+
+
+class _QueryCounter(object):
+    def __init__(self, tag):
+        self.tag = tag
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self.wrappers = [conn.execute_wrapper(self) for conn in connections.all()]
+        for wrapper in self.wrappers:
+            wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        for wrapper in reversed(self.wrappers):
+            wrapper.__exit__(*exc_info)
+        incr('currencies_template_queries_total', self.count, tag=self.tag)
+        incr('currencies_template_renders_total', tag=self.tag)
+        return False
+
+
+def queries(tag):
+    """Context manager counting the db queries made by a template tag"""
+    if not enabled:
+        return _null
+    return _QueryCounter(tag)
+
+
+class LoggingSink(object):
+    """Logs every record to the django.currencies.metrics logger"""
+    level = logging.DEBUG
+
+    def record(self, kind, name, value, labels):
+        logger.log(self.level, "%s %s%s %s", kind, name, _format_labels(labels), value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in sorted(labels.items()))
+
+
+class PrometheusSink(object):
+    """Aggregates records in process for the Prometheus text exposition view"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = {}
+        self.values = {}
+
+    def record(self, kind, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.kinds[name] = kind
+            if kind == 'gauge':
+                self.values[key] = value
+            elif kind == 'summary':
+                total, count = self.values.get(key, (0, 0))
+                self.values[key] = (total + value, count + 1)
+            else:
+                self.values[key] = self.values.get(key, 0) + value
+
+    def render(self, extra=()):
+        """Returns the text exposition format of the aggregated and any extra (kind, name, value, labels)"""
+        lines = []
+        with self.lock:
+            items = sorted(self.values.items())
+            kinds = dict(self.kinds)
+        for kind, name, value, labels in extra:
+            kinds[name] = kind
+            items.append(((name, tuple(sorted(labels.items()))), value))
+        items.sort(key=lambda item: item[0])
+
+        current = None
+        for (name, labels), value in items:
+            kind = kinds[name]
+            if name != current:
+                lines.append('# TYPE %s %s' % (name, kind))
+                current = name
+            labels = _format_labels(dict(labels))
+            if kind == 'summary':
+                lines.append('%s_sum%s %s' % (name, labels, value[0]))
+                lines.append('%s_count%s %s' % (name, labels, value[1]))
+            else:
+                lines.append('%s%s %s' % (name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+def rate_timestamps():
+    """Gauges of the source timestamp of each active currency rate, read from the db"""
+    from .models import Currency
+    for code, updated in Currency.active.values_list('code', 'rate_updated'):
+        if updated:
+            # Naive timestamps are written in local time by updatecurrencies
+            seconds = timegm(updated.utctimetuple()) if updated.tzinfo else time.mktime(updated.timetuple())
+            yield ('gauge', 'currencies_rate_timestamp_seconds', int(seconds), {'code': code})
+
+
+def prometheus_view(request):
+    """Prometheus text exposition of this process, add to your urls when enabled"""
+    for sink in sinks:
+        if isinstance(sink, PrometheusSink):
+            return HttpResponse(sink.render(rate_timestamps()),
+                content_type='text/plain; version=0.0.4; charset=utf-8')
+    raise Http404("Prometheus metrics are not enabled")
+
+
+configure(METRICS_SINKS)
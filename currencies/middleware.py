@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from .utils import get_currency_code, aget_currency_code, request_scope
+
+
+class CurrencyMiddleware(object):
+    """
+    Sets request.currency_code, the currency chosen for the request, and shares
+    one converter between the conversions of the request, see request_scope().
+    Runs natively in both sync and async middleware chains, so ASGI
+    deployments do not pay a thread hop per request
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with request_scope():
+            request.currency_code = get_currency_code(request)
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        with request_scope():
+            request.currency_code = await aget_currency_code(request)
+            return await self.get_response(request)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def keep_one_flag(apps, schema_editor):
+    """Leave a single base and default currency, the active ones first then by code, for the constraints"""
+    Currency = apps.get_model('currencies', 'Currency')
+    db = schema_editor.connection.alias
+    for flag in ('is_base', 'is_default'):
+        flagged = Currency.objects.using(db).filter(**{flag: True}).order_by('-is_active', 'code')
+        kept = flagged.values_list('pk', flat=True).first()
+        if kept is not None:
+            flagged.exclude(pk=kept).update(**{flag: False})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('currencies', '0006_increase_name_max_length'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='currency',
+            name='info',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.RunPython(keep_one_flag, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='currency',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_base', True)), fields=('is_base',), name='currencies_currency_unique_base'),
+        ),
+        migrations.AddConstraint(
+            model_name='currency',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_default', True)), fields=('is_default',), name='currencies_currency_unique_default'),
+        ),
+    ]
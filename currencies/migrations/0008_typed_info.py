@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+
+def info_to_columns(apps, schema_editor):
+    """Copy the promoted info keys to their columns, the info is left as it is"""
+    Currency = apps.get_model('currencies', 'Currency')
+    db = schema_editor.connection.alias
+    currencies = []
+    for currency in Currency.objects.using(db).all():
+        info = currency.info or {}
+        currency.iso_number = info.get('ISO4217Number')
+        currency.exponent = info.get('ISO4217Exponent')
+        try:
+            updated = parse_datetime(info.get('RateUpdate') or '')
+        except ValueError:
+            updated = None
+        if updated is not None:
+            if settings.USE_TZ and timezone.is_naive(updated):
+                updated = timezone.make_aware(updated)
+            elif not settings.USE_TZ and timezone.is_aware(updated):
+                updated = timezone.make_naive(updated)
+        currency.rate_updated = updated
+        currencies.append(currency)
+    Currency.objects.using(db).bulk_update(
+        currencies, ['iso_number', 'exponent', 'rate_updated'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('currencies', '0007_unique_base_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='currency',
+            name='exponent',
+            field=models.PositiveSmallIntegerField(blank=True, db_index=True, help_text='The number of decimal places of the minor unit.', null=True, verbose_name='exponent'),
+        ),
+        migrations.AddField(
+            model_name='currency',
+            name='iso_number',
+            field=models.PositiveSmallIntegerField(blank=True, db_index=True, null=True, verbose_name='ISO 4217 number'),
+        ),
+        migrations.AddField(
+            model_name='currency',
+            name='rate_source',
+            field=models.CharField(blank=True, db_index=True, max_length=20, verbose_name='rate source'),
+        ),
+        migrations.AddField(
+            model_name='currency',
+            name='rate_updated',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='The timestamp of the rate at its source.', null=True, verbose_name='rate updated'),
+        ),
+        migrations.RunPython(info_to_columns, migrations.RunPython.noop),
+    ]
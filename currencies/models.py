@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
 
 from six import python_2_unicode_compatible
-from django.db import models
+from django.db import models, router, transaction
+from django.db.models import Q
 from django.utils.translation import gettext_lazy as _
 
-from .managers import CurrencyManager
+from .managers import CurrencyManager, CurrencyQuerySet, send_default_changed
 
 
 @python_2_unicode_compatible
@@ -26,29 +27,68 @@ class Currency(models.Model):
     is_default = models.BooleanField(_('default'), default=False,
         help_text=_('Make this the default user currency.'))
 
+    # The attributes worth querying, also kept in info for compatibility
+    iso_number = models.PositiveSmallIntegerField(_('ISO 4217 number'), null=True, blank=True,
+                            db_index=True)
+    exponent = models.PositiveSmallIntegerField(_('exponent'), null=True, blank=True,
+                            db_index=True,
+        help_text=_('The number of decimal places of the minor unit.'))
+    rate_updated = models.DateTimeField(_('rate updated'), null=True, blank=True,
+                            db_index=True,
+        help_text=_('The timestamp of the rate at its source.'))
+    rate_source = models.CharField(_('rate source'), max_length=20, blank=True,
+                            db_index=True)
+
     # Used to store other available information about a currency
     info = models.JSONField(blank=True, default=dict)
-    objects = models.Manager()
+    objects = CurrencyQuerySet.as_manager()
     active = CurrencyManager()
 
     class Meta:
         ordering = ['name']
         verbose_name = _('currency')
         verbose_name_plural = _('currencies')
+        constraints = [
+            # Also the indexes of the active.base() and active.default() lookups
+            models.UniqueConstraint(fields=['is_base'], condition=Q(is_base=True),
+                                    name='currencies_currency_unique_base'),
+            models.UniqueConstraint(fields=['is_default'], condition=Q(is_default=True),
+                                    name='currencies_currency_unique_default'),
+        ]
 
     def __str__(self):
         return self.code
 
-    def save(self, **kwargs):
-        # Make sure the base and default currencies are unique
-        if self.is_base is True:
-            self.__class__._default_manager.filter(is_base=True).update(is_base=False)
-
-        if self.is_default is True:
-            self.__class__._default_manager.filter(is_default=True).update(is_default=False)
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Currency, cls).from_db(db, field_names, values)
+        # The flags as saved, see save()
+        instance._flags = (instance.__dict__.get('is_base'), instance.__dict__.get('is_default'))
+        return instance
 
+    def save(self, **kwargs):
         # Make sure default / base currency is active
         if self.is_default or self.is_base:
             self.is_active = True
 
-        super(Currency, self).save(**kwargs)
+        # Make sure the base and default currencies are unique, by taking the flags
+        # from another currency in the same transaction. Unchanged flags need no update
+        saved_base, saved_default = getattr(self, '_flags', (None, None))
+        clear = {}
+        if self.is_base is True and saved_base is not True:
+            clear['is_base'] = False
+        if self.is_default is True and saved_default is not True:
+            clear['is_default'] = False
+        if not clear:
+            super(Currency, self).save(**kwargs)
+        else:
+            using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+            flagged = Q()
+            for flag in clear:
+                flagged |= Q(**{flag: True})
+            with transaction.atomic(using=using):
+                self.__class__._default_manager.using(using).filter(flagged).exclude(pk=self.pk).update(**clear)
+                super(Currency, self).save(**kwargs)
+                if 'is_default' in clear:
+                    send_default_changed(self.__class__, self.code, using)
+        self._flags = (self.is_base, self.is_default)
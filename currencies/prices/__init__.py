@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+"""
+Optional app keeping a denormalized table of prices precomputed in every
+active currency, for models registered with currencies.prices.registry.register()
+"""
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+from django.apps import AppConfig
+from django.utils.translation import gettext_lazy as _
+
+
+class PricesConfig(AppConfig):
+    name = 'currencies.prices'
+    label = 'currencies_prices'
+    verbose_name = _('converted prices')
+    default_auto_field = 'django.db.models.AutoField'
+
+    def ready(self):
+        from ..signals import default_changed, rates_updated
+        from .registry import _default_changed, _rates_updated
+        rates_updated.connect(_rates_updated, dispatch_uid='currencies.prices')
+        default_changed.connect(_default_changed, dispatch_uid='currencies.prices')
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from ...registry import refresh
+
+
+class Command(BaseCommand):
+    help = "Recompute the stored converted prices of all registered models"
+
+    def add_arguments(self, parser):
+        """Add command arguments"""
+        parser.add_argument('codes', nargs='*',
+            help='Only recompute prices affected by these currency codes, default is everything')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+            help='Number of objects recomputed and written per batch')
+        parser.add_argument('--database', action='store', default=None,
+            help='Nominates the database alias to refresh, the default is as routed')
+
+    def handle(self, *args, **options):
+        """Handle the command"""
+        written = refresh(options['codes'] or None, chunk_size=options['chunk_size'],
+            using=options['database'])
+        self.stdout.write("Refreshed %d converted prices" % written)
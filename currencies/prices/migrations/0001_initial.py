@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('currencies', '0006_increase_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConvertedPrice',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.CharField(max_length=255, verbose_name='object id')),
+                ('field', models.CharField(max_length=55, verbose_name='field')),
+                ('amount', models.DecimalField(decimal_places=10, max_digits=30, null=True, verbose_name='amount')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='contenttypes.contenttype')),
+                ('currency', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='currencies.currency')),
+            ],
+            options={
+                'verbose_name': 'converted price',
+                'verbose_name_plural': 'converted prices',
+                'indexes': [models.Index(fields=['content_type', 'field', 'currency', 'amount'], name='currencies_prices_lookup_idx')],
+                'unique_together': {('content_type', 'field', 'currency', 'object_id')},
+            },
+        ),
+    ]
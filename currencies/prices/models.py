@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+from six import python_2_unicode_compatible
+from django.db import models
+from django.contrib.contenttypes.models import ContentType
+from django.utils.translation import gettext_lazy as _
+
+from ..models import Currency
+
+
+@python_2_unicode_compatible
+class ConvertedPrice(models.Model):
+
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE,
+                            related_name='+')
+    object_id = models.CharField(_('object id'), max_length=255)
+    field = models.CharField(_('field'), max_length=55)
+    currency = models.ForeignKey(Currency, on_delete=models.CASCADE,
+                            related_name='+')
+    amount = models.DecimalField(_('amount'), max_digits=30, decimal_places=10,
+                            null=True)
+
+    class Meta:
+        verbose_name = _('converted price')
+        verbose_name_plural = _('converted prices')
+        unique_together = ('content_type', 'field', 'currency', 'object_id')
+        # Faceted search: one currency of one field, filtered or ordered by amount
+        indexes = [
+            models.Index(fields=['content_type', 'field', 'currency', 'amount'],
+                name='currencies_prices_lookup_idx'),
+        ]
+
+    def __str__(self):
+        return '%s %s' % (self.amount, self.currency_id)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import CharField, F, OuterRef, Subquery
+from django.db.models.functions import Cast
+from django.db.models.signals import post_save, post_delete
+
+from ..expressions import Converted
+from ..models import Currency as C
+from .models import ConvertedPrice
+
+
+logger = logging.getLogger("django.currencies")
+
+# Registered price fields: {(model, field): options}
+_registry = {}
+
+
+def register(model, field='price', from_field=None, from_code=None, decimals=2):
+    """
+    Keep precomputed conversions of model.field in every active currency.
+    The source currency is taken like expressions.Converted: from_field,
+    from_code or the default currency
+    """
+    _registry[(model, field)] = {
+        'from_field': from_field,
+        'from_code': from_code,
+        'decimals': decimals,
+    }
+    post_save.connect(_object_saved, sender=model, dispatch_uid='currencies.prices')
+    post_delete.connect(_object_deleted, sender=model, dispatch_uid='currencies.prices')
+
+
+def unregister(model, field='price'):
+    del _registry[(model, field)]
+    if not any(m is model for m, f in _registry):
+        post_save.disconnect(sender=model, dispatch_uid='currencies.prices')
+        post_delete.disconnect(sender=model, dispatch_uid='currencies.prices')
+
+
+def _source_codes(options, using=None):
+    """The fixed source currency of a registration, or None if it varies per object"""
+    if options['from_field']:
+        return None
+    if options['from_code']:
+        return options['from_code']
+    return C.active.db_manager(using).default().code
+
+
+def _write(model, field, rows, codes, using=None):
+    """Replace the stored prices of a chunk of (pk, amount, ...) rows in the given currencies"""
+    ct = ContentType.objects.db_manager(using).get_for_model(model)
+    ids = [str(row[0]) for row in rows]
+    prices = ConvertedPrice.objects.db_manager(using)
+    with transaction.atomic(using=prices.db):
+        prices.filter(content_type=ct, field=field,
+            currency__in=codes, object_id__in=ids).delete()
+        prices.bulk_create(
+            ConvertedPrice(content_type=ct, field=field, object_id=object_id,
+                currency_id=code, amount=amount)
+            for object_id, row in zip(ids, rows)
+            for code, amount in zip(codes, row[1:]))
+    return len(rows) * len(codes)
+
+
+def _refresh_qs(model, field, options, qs, codes, chunk_size, using=None):
+    """Recompute the prices of a queryset in the given currencies, chunk by chunk"""
+    annotations = dict(
+        ('_currencies_%s' % code, Converted(F(field), to=code,
+            from_field=options['from_field'], from_code=options['from_code'],
+            decimals=options['decimals']))
+        for code in codes)
+    values = qs.annotate(**annotations).values_list('pk', *annotations).order_by('pk')
+
+    written, chunk = 0, []
+    for row in values.iterator(chunk_size=chunk_size):
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            written += _write(model, field, chunk, codes, using)
+            chunk = []
+    if chunk:
+        written += _write(model, field, chunk, codes, using)
+    return written
+
+
+def refresh(codes=None, chunk_size=1000, using=None):
+    """
+    Recompute the stored prices affected by a change in the given currency factors,
+    or everything if no codes are supplied. Returns the number of rows written.
+    Reads and writes the 'using' database alias if supplied, otherwise as routed.
+    A changed factor affects conversions to that currency for every object,
+    and conversions to every currency for objects priced in it
+    """
+    active = list(C.active.db_manager(using).values_list('code', flat=True))
+    if codes is None:
+        # Currencies deactivated since are no longer refreshed, their prices would go stale
+        ConvertedPrice.objects.db_manager(using).exclude(currency__in=active).delete()
+    written = 0
+    for (model, field), options in _registry.items():
+        qs = model._default_manager.db_manager(using).all()
+        source = _source_codes(options, using)
+        if codes is None or source in codes:
+            written += _refresh_qs(model, field, options, qs, active, chunk_size, using)
+            continue
+
+        changed = [code for code in active if code in codes]
+        if changed:
+            written += _refresh_qs(model, field, options, qs, changed, chunk_size, using)
+        if source is None:
+            unchanged = [code for code in active if code not in codes]
+            priced_in = qs.filter(**{'%s__in' % options['from_field']: codes})
+            if unchanged:
+                written += _refresh_qs(model, field, options, priced_in, unchanged, chunk_size, using)
+    return written
+
+
+def annotate_price(qs, code, field='price', name=None):
+    """Annotate a queryset of a registered model with its stored price in a currency"""
+    prices = ConvertedPrice.objects.filter(
+        content_type=ContentType.objects.get_for_model(qs.model),
+        field=field, currency=code,
+        object_id=Cast(OuterRef('pk'), CharField()))
+    return qs.annotate(**{name or '%s_%s' % (field, code.lower()):
+        Subquery(prices.values('amount')[:1])})
+
+
+def _object_saved(sender, instance, raw=False, using=None, **kwargs):
+    if raw:
+        return
+    active = list(C.active.db_manager(using).values_list('code', flat=True))
+    qs = sender._default_manager.db_manager(using).filter(pk=instance.pk)
+    for (model, field), options in _registry.items():
+        if model is sender:
+            _refresh_qs(model, field, options, qs, active, 1, using)
+
+
+def _object_deleted(sender, instance, using=None, **kwargs):
+    ConvertedPrice.objects.db_manager(using).filter(
+        content_type=ContentType.objects.db_manager(using).get_for_model(sender),
+        object_id=str(instance.pk)).delete()
+
+
+def _rates_updated(sender, changes, using=None, **kwargs):
+    """Refresh the prices affected by an updatecurrencies run"""
+    if _registry:
+        logger.info("Refreshed %d converted prices", refresh(list(changes), using=using))
+
+
+def _default_changed(sender, code, using=None, **kwargs):
+    """Refresh the prices converted from the default currency, which is now another one"""
+    active = list(C.active.db_manager(using).values_list('code', flat=True))
+    written = 0
+    for (model, field), options in _registry.items():
+        if not options['from_field'] and not options['from_code']:
+            qs = model._default_manager.db_manager(using).all()
+            written += _refresh_qs(model, field, options, qs, active, 1000, using)
+    if written:
+        logger.info("Refreshed %d converted prices from the new default currency %s", written, code)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Optional shared rate table. When CURRENCY_RATE_TABLE names a local file,
+updatecurrencies publishes the currency factors to it in a compact fixed
+layout, replacing it atomically. Every worker process memory maps the file,
+so the pages are shared, and follows each replacement without any db or
+cache round trip. Saving or deleting a currency, and the set_base() and
+set_default() queryset methods, publish the table again once committed.
+
+Layout, little endian:
+    header   4s magic, H format, H count, Q version, from a hash of the entries
+    entries  count * (3s code, B flags, 16s factor * 10**10 as a signed integer),
+             sorted by code
+"""
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+from decimal import Decimal
+
+from django.db import transaction
+
+from .conf import RATE_TABLE
+
+
+logger = logging.getLogger("django.currencies")
+
+MAGIC = b'CURT'
+FORMAT = 2
+HEADER = struct.Struct('<4sHHQ')
+ENTRY = struct.Struct('<3sB16s')
+# The decimal places of Currency.factor
+SCALE = 10
+
+ACTIVE, BASE, DEFAULT = 1, 2, 4
+
+
+def version_of(entries):
+    """The version of the packed entries, the same for the same rates whoever writes them"""
+    return int.from_bytes(hashlib.sha1(entries).digest()[:8], 'little')
+
+
+def pack(currencies):
+    """Return the table of an iterable of Currency objects as bytes"""
+    entries = []
+    for currency in sorted(currencies, key=lambda c: c.code):
+        flags = ((ACTIVE if currency.is_active else 0) |
+                 (BASE if currency.is_base else 0) |
+                 (DEFAULT if currency.is_default else 0))
+        factor = int(Decimal(currency.factor).scaleb(SCALE).to_integral_value())
+        entries.append(ENTRY.pack(currency.code.encode('ascii'), flags,
+                                  factor.to_bytes(16, 'little', signed=True)))
+    entries = b''.join(entries)
+    return HEADER.pack(MAGIC, FORMAT, len(entries) // ENTRY.size, version_of(entries)) + entries
+
+
+def write(currencies, path=None):
+    """
+    Publish the currencies to the table file unless it already holds them.
+    The file is replaced atomically. The version is derived from the rates, not from
+    the previous file, so that concurrent writers or a removed file cannot give two
+    tables the same version. Returns the version of the table
+    """
+    path = path or RATE_TABLE
+    data = pack(currencies)
+    version = HEADER.unpack_from(data)[3]
+    previous = load(path)
+    if previous:
+        unchanged = previous.entries() == data[HEADER.size:]
+        # Only compared, unlike the table of the process mapped by get()
+        previous.close()
+        if unchanged:
+            return version
+
+    tmpfile = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmpfile, 'wb') as fd:
+        fd.write(data)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(tmpfile, path)
+    return version
+
+
+class RateTable(object):
+    """A read-only view of a table file mapped into memory"""
+
+    def __init__(self, buf):
+        magic, fmt, self.count, _ = HEADER.unpack_from(buf)
+        if magic != MAGIC or fmt != FORMAT or len(buf) != HEADER.size + self.count * ENTRY.size:
+            raise ValueError("Not a currency rate table of format %d" % FORMAT)
+        self.buf = buf
+        # The conversion cache is keyed on it, so it is taken from the rates read, not the header
+        self.version = version_of(self.entries())
+        # Only the codes are indexed, the factors are read from the shared pages when used
+        self.index = {}
+        self.default_code = None
+        for i in range(self.count):
+            offset = HEADER.size + i * ENTRY.size
+            code, flags = struct.unpack_from('<3sB', buf, offset)
+            code = code.decode('ascii')
+            if flags & ACTIVE:
+                self.index[code] = offset
+                if flags & DEFAULT:
+                    self.default_code = code
+
+    def entries(self):
+        return self.buf[HEADER.size:]
+
+    def close(self):
+        """Unmap the file, the table cannot be read afterwards"""
+        self.buf.close()
+
+    def __contains__(self, code):
+        return code in self.index
+
+    def factor(self, code):
+        """The Decimal factor of an active currency, or KeyError"""
+        offset = self.index[code] + 4
+        return Decimal(int.from_bytes(self.buf[offset:offset + 16], 'little', signed=True)).scaleb(-SCALE)
+
+
+def load(path):
+    """Map a table file, or return None if it is missing or invalid"""
+    try:
+        with open(path, 'rb') as fd:
+            buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        return None
+    try:
+        return RateTable(buf)
+    except (ValueError, struct.error) as e:
+        logger.warning("Ignoring the currency rate table %s: %s", path, e)
+        return None
+
+
+def republish(model, using):
+    """
+    Publish the currencies of the database again once the current transaction
+    commits, after a change made outside updatecurrencies
+    """
+    if RATE_TABLE:
+        transaction.on_commit(lambda: write(model._default_manager.using(using).all()), using=using)
+
+
+def currency_changed(sender, using, **kwargs):
+    """The post_save and post_delete receiver of Currency, see CurrenciesConfig.ready()"""
+    republish(sender, using)
+
+
+_lock = threading.Lock()
+_table = None
+_stat = None
+
+
+def get():
+    """
+    The current table of this process, or None if not configured or not published.
+    A stat of the file on each call picks up a replacement, which is then mapped once
+    """
+    global _table, _stat
+    if not RATE_TABLE:
+        return None
+    try:
+        st = os.stat(RATE_TABLE)
+        stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+    except OSError:
+        stat = None
+    if stat != _stat:
+        with _lock:
+            if stat != _stat:
+                # A table being replaced is released when no longer referenced
+                _table = load(RATE_TABLE) if stat else None
+                _stat = stat
+    return _table
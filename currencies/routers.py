@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+from .conf import READ_DATABASE, WRITE_DATABASE
+
+
+class CurrencyRouter(object):
+    """
+    Routes reads of the currencies models to CURRENCY_READ_DATABASE, e.g. a
+    read replica or local mirror, and writes to CURRENCY_WRITE_DATABASE.
+    Add 'currencies.routers.CurrencyRouter' to DATABASE_ROUTERS
+    """
+    app_labels = ('currencies', 'currencies_prices')
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label in self.app_labels:
+            return READ_DATABASE
+        return None
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label in self.app_labels:
+            return WRITE_DATABASE
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The aliases hold the same data
+        if obj1._meta.app_label in self.app_labels or obj2._meta.app_label in self.app_labels:
+            return True
+        return None
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from collections import namedtuple
+
+from django.dispatch import Signal
+
+
+# The change of rate of one currency, timestamp is of the rate at its source or of the update
+RateChange = namedtuple('RateChange', ['old', 'new', 'timestamp'])
+
+# Sent once by each updatecurrencies run that changed any rates, after the rate table
+# and snapshot are written. Keyword arguments:
+#   changes  {code: RateChange} of the changed currencies
+#   version  the version of the new rates, a hash of the active factors
+#   table_version  the version of the rate table written, or None
+#   snapshot_version  the version of the snapshot written, or None
+#   source   the name of the rates source, e.g. 'oxr'
+#   using    the database alias written
+rates_updated = Signal()
+
+# Sent once committed when another currency becomes the default, by Currency.save()
+# or set_default(). Keyword arguments:
+#   code     the code of the new default currency
+#   using    the database alias written
+default_changed = Signal()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Optional last-known-good snapshot of the currencies. When CURRENCY_SNAPSHOT
+names a local file, updatecurrencies saves the currencies to it as JSON.
+Each process loads it once, and the conversions fall back to it whenever the
+database is unavailable. After a database error the snapshot is served for
+CURRENCY_SNAPSHOT_RETRY seconds before the database is tried again, and
+stale() is True for as long as it is being served.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from decimal import Decimal
+
+from django.utils.dateparse import parse_datetime
+
+from .conf import SNAPSHOT, SNAPSHOT_RETRY
+from . import metrics
+
+
+logger = logging.getLogger("django.currencies")
+
+FIELDS = ('code', 'name', 'symbol', 'factor', 'is_active', 'is_base', 'is_default', 'iso_number', 'exponent')
+
+
+def dump(currencies):
+    """Return the snapshot document of an iterable of Currency objects"""
+    rows = [dict((field, str(getattr(currency, field)) if field == 'factor' else getattr(currency, field))
+                 for field in FIELDS)
+            for currency in sorted(currencies, key=lambda c: c.code)]
+    version = hashlib.sha1(json.dumps(rows, sort_keys=True).encode('utf-8')).hexdigest()
+    return {'version': version, 'written': datetime.now().isoformat(), 'currencies': rows}
+
+
+def write(currencies, path=None):
+    """Save the currencies to the snapshot file atomically, returns the version"""
+    path = path or SNAPSHOT
+    document = dump(currencies)
+    tmpfile = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmpfile, 'w') as fd:
+        json.dump(document, fd, indent=1)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(tmpfile, path)
+    return document['version']
+
+
+class Snapshot(object):
+    """The active currencies of a snapshot document"""
+
+    def __init__(self, document):
+        self.version = document['version']
+        self.written = parse_datetime(document['written'])
+        self.currencies = {}
+        self.default_code = None
+        for row in document['currencies']:
+            if row['is_active']:
+                row['factor'] = Decimal(row['factor'])
+                self.currencies[row['code']] = row
+                if row['is_default']:
+                    self.default_code = row['code']
+
+    def __contains__(self, code):
+        return code in self.currencies
+
+    def factor(self, code):
+        """The Decimal factor of an active currency, or KeyError"""
+        return self.currencies[code]['factor']
+
+    def instance(self, model, code, using=None):
+        """An active currency as an instance of the Currency model, or None"""
+        row = self.currencies.get(code)
+        if row is None:
+            return None
+        # Snapshots written by older versions have fewer fields
+        fields = [field for field in FIELDS if field in row]
+        return model.from_db(using, fields, [row[field] for field in fields])
+
+    def instances(self, model, using=None):
+        """The active currencies as instances of the Currency model, ordered by name"""
+        return sorted((self.instance(model, code, using) for code in self.currencies), key=lambda c: c.name)
+
+
+def load(path):
+    """Load a snapshot file, or return None if it is missing or invalid"""
+    try:
+        with open(path) as fd:
+            return Snapshot(json.load(fd))
+    except (IOError, OSError):
+        return None
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning("Ignoring the currency snapshot %s: %s", path, e)
+        return None
+
+
+_lock = threading.Lock()
+_snapshot = None
+_stat = None
+_retry_at = None
+
+
+def get():
+    """The snapshot of this process, or None. Reloaded when the file is replaced"""
+    global _snapshot, _stat
+    if not SNAPSHOT:
+        return None
+    try:
+        st = os.stat(SNAPSHOT)
+        stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+    except OSError:
+        # Keep serving the one loaded
+        return _snapshot
+    if stat != _stat:
+        with _lock:
+            if stat != _stat:
+                _snapshot = load(SNAPSHOT) or _snapshot
+                _stat = stat
+    return _snapshot
+
+
+def unavailable():
+    """
+    Called on a database error, returns the snapshot to serve instead or None.
+    The database is not tried again until CURRENCY_SNAPSHOT_RETRY seconds have passed
+    """
+    global _retry_at
+    snapshot = get()
+    if snapshot is not None:
+        if _retry_at is None:
+            logger.warning("Database unavailable, serving currencies from the snapshot of %s", snapshot.written)
+        _retry_at = time.monotonic() + SNAPSHOT_RETRY
+        metrics.incr('currencies_snapshot_fallbacks_total')
+    return snapshot
+
+
+def serving():
+    """The snapshot while it stands in for the database, None when the database should be tried"""
+    global _retry_at
+    if _retry_at is None:
+        return None
+    if time.monotonic() >= _retry_at:
+        # Revalidate: the next lookup tries the database, and comes back on failure
+        _retry_at = None
+        return None
+    return get()
+
+
+def stale():
+    """True while the conversions are being served from the snapshot"""
+    return _retry_at is not None
@@ -1,14 +1,44 @@
 # -*- coding: utf-8 -*-
 
+import re
+from decimal import Decimal
+from inspect import getfullargspec, unwrap
+
 from django import template
-from django.template.defaultfilters import stringfilter
+from django.template.base import token_kwargs
+from django.template.library import SimpleNode, parse_bits
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.functional import SimpleLazyObject
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
 
 from currencies.models import Currency
-from currencies.utils import get_currency_code, calculate
+from currencies.utils import (
+    calculate, get_currency_code, get_currency as get_active_currency, get_active_currencies,
+    currency_cache_key as cache_key, price_currency, to_decimal, request_converter, converter_for, Converter)
+from currencies import metrics, snapshot
 
 register = template.Library()
 
 
+def get_converter(context):
+    """The converter shared by the currency tags during one render of a template, or of the request"""
+    converter = context.render_context.get(Converter)
+    if converter is None:
+        converter = context.render_context[Converter] = request_converter() or Converter()
+    return converter
+
+
+def get_currency_code_of(context):
+    """CURRENCY_CODE of the context, lazy or not, else the currency of the request"""
+    code = context.get('CURRENCY_CODE')
+    if callable(code):
+        code = code()
+    if code is None:
+        code = get_currency_code(context.get('request'))
+    return code
+
+
 class ChangeCurrencyNode(template.Node):
 
     def __init__(self, price, currency):
@@ -17,9 +47,14 @@ class ChangeCurrencyNode(template.Node):
 
     def render(self, context):
         try:
-            return calculate(self.price.resolve(context), self.currency.resolve(context))
+            price, code = self.price.resolve(context), self.currency.resolve(context)
         except template.VariableDoesNotExist:
             return ''
+        block = context.get(_BLOCK)
+        if block is not None:
+            return block.add(price, code, get_converter(context).default_code)
+        with metrics.queries('change_currency'):
+            return str(get_converter(context).convert(price, code))
 
 
 @register.tag(name='change_currency')
@@ -33,15 +68,214 @@ def change_currency(parser, token):
     return ChangeCurrencyNode(current_price, new_currency)
 
 
-@register.simple_tag
 def show_currency(price, code, decimals=2):
     return calculate(price, code, decimals=decimals)
 
 
-@stringfilter
+class ShowCurrencyNode(SimpleNode):
+    """
+    Converts with the converter of the render, or inside a currencyblock leaves
+    the conversion to the block, unless assigned with as
+    """
+
+    def render(self, context):
+        args, kwargs = self.get_resolved_arguments(context)
+        block = context.get(_BLOCK)
+        if block is not None and self.target_var is None:
+            return self.add(block, get_converter(context), *args, **kwargs)
+        with metrics.queries('show_currency'):
+            output = self.convert(get_converter(context), *args, **kwargs)
+        if self.target_var is not None:
+            context[self.target_var] = output
+            return ''
+        if context.autoescape:
+            output = conditional_escape(output)
+        return output
+
+    @staticmethod
+    def add(block, converter, price, code, decimals=2):
+        return block.add(price, code, converter.default_code, decimals)
+
+    @staticmethod
+    def convert(converter, price, code, decimals=2):
+        return converter.convert(price, code, decimals=decimals)
+
+
+@register.tag(name='show_currency')
+def do_show_currency(parser, token):
+    """{% show_currency price code [decimals] [as var] %} converts a price from the default currency"""
+    bits = token.split_contents()[1:]
+    target_var = None
+    if len(bits) >= 2 and bits[-2] == 'as':
+        target_var = bits[-1]
+        bits = bits[:-2]
+    params, varargs, varkw, defaults, kwonly, kwonly_defaults, _ = getfullargspec(unwrap(show_currency))
+    args, kwargs = parse_bits(parser, bits, params, varargs, varkw, defaults,
+                              kwonly, kwonly_defaults, False, 'show_currency')
+    return ShowCurrencyNode(show_currency, False, args, kwargs, target_var)
+
+
+@register.simple_tag(takes_context=True)
+def currency_cache_key(context, code=None, *codes):
+    """
+    {% currency_cache_key [code [from_code ...]] as key %}{% cache 600 tile product.pk key %}
+    The key changes only with the rate of the currency, CURRENCY_CODE of the context by default,
+    of the default currency and of the other currencies given that the prices are converted from.
+    Unknown or inactive currencies give a key of their own rather than an error
+    """
+    if code is None:
+        code = get_currency_code_of(context)
+    with metrics.queries('currency_cache_key'):
+        try:
+            return cache_key(code, *codes, converter=get_converter(context))
+        except Currency.DoesNotExist:
+            return '%s.none' % code
+
+
 @register.filter(name='currency')
 def do_currency(price, code):
-    return calculate(price, code)
+    """
+    Converts a Decimal, int, float, string or Money-like price without a string round trip.
+    Filters cannot see the render, the rates are those of the request or of the codes used
+    """
+    with metrics.queries('currency'):
+        return converter_for(code, price_currency(price)).convert(price, code)
+
+
+def _signature(fields):
+    return salted_hmac('currencies.currencyblock', fields).hexdigest()[:16]
+
+
+class _Block(object):
+    """
+    A currencyblock being rendered. The prices are output as placeholders holding
+    the amount, the codes and the decimals, empty for those of the block, so that
+    a placeholder cached by {% cache %} in an earlier render is still converted.
+    Nested blocks are told apart by their depth in the render. The placeholders
+    are signed, the same text from a variable is left as it is
+    """
+
+    def __init__(self, depth, to, decimals=2, **kwargs):
+        self.depth = depth
+        self.to_code, self.from_code, self.decimals = to, kwargs.get('from'), decimals
+        self.pattern = re.compile('\x1a%d:([^\x1a]*)\x1a' % depth)
+
+    def add(self, price, to_code='', from_code='', decimals=''):
+        amount, code = to_decimal(price)
+        fields = '%s:%s:%s:%s' % (amount, code or from_code or '', to_code or '', decimals)
+        return '\x1a%d:%s:%s\x1a' % (self.depth, fields, _signature(fields))
+
+    def parse(self, placeholder):
+        """The conversion and amount of a placeholder, or None if it was not output by add()"""
+        fields, _, signature = placeholder.rpartition(':')
+        if not constant_time_compare(signature, _signature(fields)):
+            return None
+        amount, from_code, to_code, decimals = fields.split(':')
+        key = (from_code or self.from_code, to_code or self.to_code,
+               int(decimals) if decimals else self.decimals)
+        return key, Decimal(amount)
+
+    def convert(self, price, converter):
+        """Convert a price as the block does"""
+        return converter.convert(price, self.to_code, self.from_code, self.decimals)
+
+    def substitute(self, output, converter):
+        """Replace the placeholders of the output with the prices converted in one batch per conversion"""
+        batches = {}
+        for placeholder in set(self.pattern.findall(output)):
+            parsed = self.parse(placeholder)
+            if parsed is not None:
+                key, amount = parsed
+                batches.setdefault(key, []).append((placeholder, amount))
+        converted = {}
+        for (from_code, to_code, decimals), prices in batches.items():
+            results = converter.convert_many([amount for _, amount in prices], to_code, from_code, decimals)
+            converted.update(zip([placeholder for placeholder, _ in prices], results))
+        output = self.pattern.sub(lambda match: str(converted.get(match.group(1), match.group(0))), output)
+        if self.depth == 0:
+            # Left by text which only looked like a placeholder
+            output = output.replace('\x1a', '')
+        return output
+
+
+_BLOCK = '_currencyblock'
+
+
+class CurrencyBlockNode(template.Node):
+
+    def __init__(self, nodelist, kwargs):
+        self.nodelist = nodelist
+        self.kwargs = kwargs
+
+    def render(self, context):
+        outer = context.get(_BLOCK)
+        kwargs = dict((key, value.resolve(context)) for key, value in self.kwargs.items())
+        block = _Block(0 if outer is None else outer.depth + 1, **kwargs)
+        with context.push(**{_BLOCK: block}):
+            output = self.nodelist.render(context)
+        if '\x1a' not in output:
+            return output
+
+        with metrics.queries('currencyblock'):
+            return mark_safe(block.substitute(output, get_converter(context)))
+
+
+@register.tag(name='currencyblock')
+def currencyblock(parser, token):
+    """
+    {% currencyblock to=CODE [from=CODE] [decimals=2] %}...{% price value %}...{% endcurrencyblock %}
+    Collects the prices of the block, and of the change_currency and show_currency tags in it,
+    and converts them in one batch with the rates resolved once
+    """
+    bits = token.split_contents()
+    tag = bits.pop(0)
+    kwargs = token_kwargs(bits, parser)
+    # token_kwargs consumes the bits it parsed
+    if bits or 'to' not in kwargs or set(kwargs) - {'to', 'from', 'decimals'}:
+        raise template.TemplateSyntaxError(
+            "%r tag requires to=CODE and optionally from=CODE and decimals=N" % tag)
+    nodelist = parser.parse(('endcurrencyblock',))
+    parser.delete_first_token()
+    return CurrencyBlockNode(nodelist, kwargs)
+
+
+class PriceNode(template.Node):
+
+    def __init__(self, price, target_var=None):
+        self.price = price
+        self.target_var = target_var
+
+    def render(self, context):
+        price = self.price.resolve(context)
+        block = context.get(_BLOCK)
+        if block is not None and self.target_var is None:
+            return block.add(price)
+        with metrics.queries('price'):
+            if block is None:
+                price = get_converter(context).convert(price, get_currency_code_of(context))
+            else:
+                # Assigned, e.g. for filters which would not keep a placeholder intact
+                price = block.convert(price, get_converter(context))
+        if self.target_var is None:
+            return str(price)
+        context[self.target_var] = price
+        return ''
+
+
+@register.tag(name='price')
+def price(parser, token):
+    """
+    {% price value [as var] %} converts the value with its currencyblock, or else
+    from the default currency to CURRENCY_CODE
+    """
+    bits = token.split_contents()
+    target_var = None
+    if len(bits) == 4 and bits[2] == 'as':
+        target_var = bits.pop()
+        bits.pop()
+    if len(bits) != 2:
+        raise template.TemplateSyntaxError("%r tag requires exactly one argument" % bits[0])
+    return PriceNode(parser.compile_filter(bits[1]), target_var)
 
 
 def memoize_nullary(f):
@@ -50,6 +284,8 @@ def memoize_nullary(f):
     long as we hold a reference to the returned function.
     """
     def func():
+        if metrics.enabled:
+            metrics.cache('currency_context', hasattr(func, 'retval'))
         if not hasattr(func, 'retval'):
             func.retval = f()
         return func.retval
@@ -61,10 +297,7 @@ def get_currency(arg):
     except TypeError:
         code = arg
 
-    try:
-        return Currency.active.get(code__iexact=code)
-    except Currency.DoesNotExist:
-        return None
+    return get_active_currency(code)
 
 
 @register.simple_tag(takes_context=True)
@@ -76,8 +309,9 @@ def currency_context(context):
     request = context['request']
     currency_code = memoize_nullary(lambda: get_currency_code(request))
 
-    context['CURRENCIES'] = Currency.active.all() # querysets are already lazy
+    context['CURRENCIES'] = SimpleLazyObject(get_active_currencies) # lazy, from the snapshot on a db error
     context['CURRENCY_CODE'] = currency_code # lazy
     context['CURRENCY'] = memoize_nullary(lambda: get_currency(currency_code)) # lazy
+    context['CURRENCY_RATES_STALE'] = snapshot.stale
 
     return ''
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+"""Models used by the test suite only"""
+from django.db import models
+
+from currencies.fields import CurrencyForeignKey
+
+
+class Product(models.Model):
+    price = models.DecimalField(max_digits=12, decimal_places=2)
+    currency = CurrencyForeignKey(on_delete=models.CASCADE, null=True, blank=True)
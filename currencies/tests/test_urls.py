@@ -2,10 +2,12 @@
 
 from django.urls import re_path, include
 from django.views.generic import TemplateView
+from currencies.views import aset_currency
 
 urlpatterns = [
     re_path(r'^currencies/', include('currencies.urls')),
     re_path(r'^$', TemplateView.as_view(template_name='index.html')),
     re_path(r'^context_processor$', TemplateView.as_view(template_name='context_processor.html')),
     re_path(r'^context_tag$', TemplateView.as_view(template_name='context_tag.html')),
+    re_path(r'^asetcurrency/$', aset_currency),
 ]
@@ -1,14 +1,37 @@
 from __future__ import unicode_literals
 import os
+import shutil
+import tempfile
+from datetime import datetime
 from decimal import Decimal, InvalidOperation
 from copy import deepcopy
+import threading
+from importlib import import_module
 
 from django import template
-from django.test import TestCase, override_settings
+from django.apps import apps
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import Q, Value
+from django.test import TestCase, TransactionTestCase, RequestFactory, AsyncRequestFactory, override_settings
+from unittest.mock import patch
+from asgiref.sync import async_to_sync, iscoroutinefunction
 
 from currencies.models import Currency
-from currencies.utils import calculate
+from currencies.conf import SESSION_KEY
+from currencies.utils import (
+    calculate, convert, conversions, get_active_currencies_qs, Converter, acalculate, aconvert, aget_currency_code, currency_cache_key,
+    request_scope, request_converter)
+from currencies.expressions import Converted, JSONSet
+from currencies.lru import LRUCache
+from currencies import metrics, ratetable, snapshot
 from currencies.context_processors import currencies as curr_cp
+from currencies.middleware import CurrencyMiddleware
+from currencies.checks import check_default_currency, check_settings
+from currencies.tests.models import Product
+from currencies.templatetags.currency import show_currency
 
 
 TEMPLATES = [
@@ -46,6 +69,470 @@ class UtilsTest(TestCase):
     def test_calculate_price_doesnotexist(self):
         self.assertRaises(Currency.DoesNotExist, calculate, '10', 'GBP')
 
+    def test_convert_many(self):
+        class Money(object):
+            def __init__(self, amount, currency):
+                self.amount, self.currency = amount, currency
+        prices = [Money(Decimal('10'), 'USD'), Money(Decimal('10'), 'EUR'), 10, '10.0', Decimal('10')]
+        self.assertEqual(Converter().convert_many(prices, 'USD'),
+            [Decimal('10'), Decimal('15.00'), Decimal('15.00'), Decimal('15.00'), Decimal('15.00')])
+        self.assertEqual(Converter().convert_many(prices, 'EUR', decimals=0),
+            [Decimal('7'), Decimal('10'), 10, '10.0', Decimal('10')])
+
+    def test_codes_only(self):
+        "Single conversions read only their currencies and the default one"
+        Currency.objects.create(code='JPY', name='Yen', factor=Decimal('160'))
+        with self.assertNumQueries(1):
+            self.assertEqual(calculate('10', 'USD'), Decimal('15.00'))
+        self.assertEqual(sorted(Converter(codes=['USD', None]).source.factors), ['EUR', 'USD'])
+
+    def test_request_scope(self):
+        "The conversions of a request share one converter"
+        with self.assertNumQueries(1), request_scope():
+            self.assertEqual(calculate('10', 'USD'), Decimal('15.00'))
+            self.assertEqual(convert('15', 'USD', 'EUR'), Decimal('10.00'))
+            self.assertIs(request_converter(), request_converter())
+        self.assertIsNone(request_converter())
+
+    def test_currency_cache_key(self):
+        usd, eur = currency_cache_key('USD'), currency_cache_key('EUR')
+        self.assertRegex(usd, r'^USD\.[0-9a-f]{12}$')
+        Currency.objects.create(code='JPY', name='Yen', factor=Decimal('160'))
+        Currency.objects.filter(code='USD').update(factor=Decimal('1.50000'))
+        self.assertEqual((currency_cache_key('USD'), currency_cache_key('EUR')), (usd, eur))
+        # Only the changed currency and those converted from the default currency
+        Currency.objects.filter(code='JPY').update(factor=Decimal('161'))
+        self.assertEqual((currency_cache_key('USD'), currency_cache_key('EUR')), (usd, eur))
+        Currency.objects.filter(code='USD').update(factor=Decimal('1.6'))
+        self.assertEqual(currency_cache_key('EUR'), eur)
+        self.assertNotEqual(currency_cache_key('USD'), usd)
+        self.assertRaises(Currency.DoesNotExist, currency_cache_key, 'GBP')
+
+
+class ModelTest(TestCase):
+    "Test the unique base and default currencies"
+    fixtures = ['currencies_test']
+
+    def test_save(self):
+        eur = Currency.objects.get(code='EUR')
+        eur.factor = Decimal('1')
+        with self.assertNumQueries(1):
+            eur.save()
+        usd = Currency.objects.get(code='USD')
+        usd.is_default = True
+        # The flag is taken from EUR in the same transaction
+        with self.assertNumQueries(4):
+            usd.save()
+        self.assertEqual(Currency.objects.default().code, 'USD')
+        self.assertEqual(Currency.objects.filter(is_default=True).count(), 1)
+        usd.is_base = usd.is_default = True
+        usd.save()
+        self.assertEqual(list(Currency.objects.filter(Q(is_base=True) | Q(is_default=True))), [usd])
+
+    def test_typed_columns(self):
+        "The promoted info keys are copied to the columns and active reads leave the info"
+        migration = import_module('currencies.migrations.0008_typed_info')
+        state = MigrationExecutor(connection).loader.project_state(('currencies', '0008_typed_info'))
+        Currency.objects.filter(code='USD').update(
+            info={'ISO4217Number': 840, 'ISO4217Exponent': 2, 'RateUpdate': '2024-10-18T00:00:00', 'Users': []})
+        migration.info_to_columns(state.apps, connection.schema_editor())
+        usd = get_active_currencies_qs().get(code='USD')
+        self.assertEqual((usd.iso_number, usd.exponent, usd.rate_updated), (840, 2, datetime(2024, 10, 18)))
+        self.assertEqual(usd.get_deferred_fields(), {'info'})
+        self.assertEqual(Currency.active.get(code='USD').get_deferred_fields(), set())
+        self.assertEqual(Currency.active.filter(exponent=2).get().code, 'USD')
+        self.assertIsNone(Currency.objects.get(code='EUR').exponent)
+
+    def test_constraints(self):
+        with transaction.atomic(), self.assertRaises(IntegrityError):
+            Currency.objects.filter(code='USD').update(is_default=True)
+        with transaction.atomic(), self.assertRaises(IntegrityError):
+            Currency.objects.filter(code='USD').update(is_base=True)
+
+    def test_swap(self):
+        Currency.objects.filter(code='USD').update(is_active=False)
+        with self.assertNumQueries(4):
+            Currency.objects.set_default('USD')
+        self.assertEqual(Currency.active.default().code, 'USD')
+        Currency.active.set_base('USD')
+        self.assertEqual(Currency.active.base().code, 'USD')
+        self.assertFalse(Currency.objects.get(code='EUR').is_base)
+        self.assertRaises(Currency.DoesNotExist, Currency.objects.set_default, 'GBP')
+        self.assertEqual(Currency.active.default().code, 'USD')
+
+    def test_swap_inactive(self):
+        "The flag is taken from an inactive currency too"
+        Currency.objects.filter(code='EUR').update(is_active=False)
+        Currency.active.set_default('USD')
+        Currency.active.filter(code='USD').set_base('USD')
+        self.assertEqual(list(Currency.objects.filter(Q(is_base=True) | Q(is_default=True))),
+            [Currency.objects.get(code='USD')])
+
+
+class UniqueFlagsMigrationTest(TransactionTestCase):
+    "Test that migrating to the unique constraints keeps a single base and default currency"
+    databases = {'default'}
+    migrate_from = [('currencies', '0006_increase_name_max_length')]
+
+    def test_keep_one_flag(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.migrate_from)
+        Currency = executor.loader.project_state(self.migrate_from).apps.get_model('currencies', 'Currency')
+        for code, is_active, is_default in (('EUR', False, True), ('GBP', True, True), ('USD', True, False)):
+            Currency.objects.create(code=code, name=code, factor=1, is_active=is_active, is_base=True, is_default=is_default)
+        executor.loader.build_graph()
+        executor.migrate(executor.loader.graph.leaf_nodes())
+        self.assertEqual(list(Currency.objects.filter(is_base=True).values_list('code', flat=True)), ['GBP'])
+        self.assertEqual(list(Currency.objects.filter(is_default=True).values_list('code', flat=True)), ['GBP'])
+
+
+class ConversionCacheTest(TestCase):
+    "Test the conversion results cache"
+    fixtures = ['currencies_test']
+
+    def setUp(self):
+        conversions.clear()
+        self.addCleanup(conversions.clear)
+
+    def test_hits(self):
+        for i in range(3):
+            self.assertEqual(convert('9.99', 'EUR', 'USD'), Decimal('14.99'))
+        self.assertEqual(convert('9.99', 'EUR', 'USD', decimals=0), Decimal('15'))
+        info = conversions.info()
+        self.assertEqual((info['hits'], info['misses'], info['size']), (2, 2, 2))
+        self.assertEqual(info['hit_rate'], 0.5)
+
+    def test_rates_version(self):
+        "A change of rates is never served from the cache"
+        self.assertEqual(convert('10', 'EUR', 'USD'), Decimal('15.00'))
+        Currency.objects.filter(code='USD').update(factor=Decimal('2'))
+        self.assertEqual(convert('10', 'EUR', 'USD'), Decimal('20.00'))
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with patch('currencies.ratetable.RATE_TABLE', os.path.join(tmpdir, 'rates.bin')):
+            ratetable.write(Currency.objects.all())
+            self.assertEqual(convert('10', 'EUR', 'USD'), Decimal('20.00'))
+            Currency.objects.filter(code='USD').update(factor=Decimal('3'))
+            ratetable.write(Currency.objects.all())
+            self.assertEqual(convert('10', 'EUR', 'USD'), Decimal('30.00'))
+        self.assertEqual(conversions.info()['hits'], 0)
+
+    def test_rate_table_version(self):
+        "A table replaced under the same header version is not served from the cache"
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'rates.bin')
+        with patch('currencies.ratetable.RATE_TABLE', path):
+            ratetable.write(Currency.objects.all())
+            self.assertEqual(convert('10', 'EUR', 'USD'), Decimal('15.00'))
+            header = ratetable.HEADER.unpack_from(ratetable.get().buf)
+            Currency.objects.filter(code='USD').update(factor=Decimal('2'))
+            data = ratetable.pack(Currency.objects.all())
+            with open(path + '.new', 'wb') as fd:
+                fd.write(ratetable.HEADER.pack(*header) + data[ratetable.HEADER.size:])
+            os.replace(path + '.new', path)
+            self.assertEqual(convert('10', 'EUR', 'USD'), Decimal('20.00'))
+
+    def test_version_lazy(self):
+        "The hash of the queried rates is only computed when a result is cached"
+        converter = Converter()
+        self.assertEqual(converter.convert('10', 'EUR'), '10')
+        self.assertNotIn('version', vars(converter.source))
+        self.assertEqual(converter.convert('10', 'USD'), Decimal('15.00'))
+        self.assertIn('version', vars(converter.source))
+
+    def test_bounded(self):
+        with patch.object(conversions, 'maxsize', 2):
+            for amount in ('1', '2', '3', '1'):
+                convert(amount, 'EUR', 'USD')
+        self.assertEqual(conversions.info()['size'], 2)
+        self.assertEqual(conversions.info()['hits'], 0)
+
+    def test_threads(self):
+        cache = LRUCache('test', 10)
+        def work(n):
+            for i in range(1000):
+                if cache.get(i % 20) is None:
+                    cache.set(i % 20, n)
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        info = cache.info()
+        self.assertEqual(info['hits'] + info['misses'], 4000)
+        self.assertEqual(info['size'], 10)
+
+
+class RateTableTest(TestCase):
+    "Test the shared rate table"
+    fixtures = ['currencies_test']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'rates.bin')
+        patcher = patch('currencies.ratetable.RATE_TABLE', self.path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_not_published(self):
+        self.assertIsNone(ratetable.get())
+        self.assertEqual(calculate('10', 'USD'), Decimal('15.00'))
+
+    def test_convert_without_queries(self):
+        ratetable.write(Currency.objects.all())
+        Currency.objects.filter(code='USD').update(factor=Decimal('2'))
+        with self.assertNumQueries(0):
+            self.assertEqual(calculate('10', 'USD'), Decimal('15.00'))
+            self.assertRaises(Currency.DoesNotExist, calculate, '10', 'GBP')
+
+    def test_versions(self):
+        "A new version is only published on change and picked up by the readers"
+        version = ratetable.write(Currency.objects.all())
+        self.assertEqual(ratetable.write(Currency.objects.all()), version)
+        self.assertEqual(ratetable.get().version, version)
+        Currency.objects.filter(code='USD').update(factor=Decimal('0.1234567891'))
+        changed = ratetable.write(Currency.objects.all())
+        self.assertNotEqual(changed, version)
+        table = ratetable.get()
+        self.assertEqual(table.version, changed)
+        self.assertEqual(table.factor('USD'), Decimal('0.1234567891'))
+        self.assertEqual(table.default_code, 'EUR')
+        Currency.objects.filter(code='USD').update(is_active=False)
+        ratetable.write(Currency.objects.all())
+        self.assertNotIn('USD', ratetable.get())
+
+    def test_versions_of_rates(self):
+        "The version follows the rates, not the previous file"
+        version = ratetable.write(Currency.objects.all())
+        os.remove(self.path)
+        Currency.objects.filter(code='USD').update(factor=Decimal('2'))
+        changed = ratetable.write(Currency.objects.all())
+        self.assertNotEqual(changed, version)
+        os.remove(self.path)
+        Currency.objects.filter(code='USD').update(factor=Decimal('1.5'))
+        self.assertEqual(ratetable.write(Currency.objects.all()), version)
+
+    def test_republished(self):
+        "Changes made outside updatecurrencies are published once committed"
+        version = ratetable.write(Currency.objects.all())
+        usd = Currency.objects.get(code='USD')
+        usd.factor = Decimal('2')
+        with self.captureOnCommitCallbacks(execute=True):
+            usd.save()
+        self.assertEqual(ratetable.get().factor('USD'), Decimal('2'))
+        with self.captureOnCommitCallbacks(execute=True):
+            Currency.objects.set_default('USD')
+        self.assertEqual(ratetable.get().default_code, 'USD')
+        with self.captureOnCommitCallbacks(execute=True):
+            usd.delete()
+        self.assertNotIn('USD', ratetable.get())
+        self.assertNotEqual(ratetable.get().version, version)
+
+    def test_write_unmaps_previous(self):
+        version = ratetable.write(Currency.objects.all())
+        previous = ratetable.load(self.path)
+        with patch('currencies.ratetable.load', return_value=previous):
+            self.assertEqual(ratetable.write(Currency.objects.all()), version)
+        self.assertTrue(previous.buf.closed)
+
+    def test_invalid(self):
+        with open(self.path, 'wb') as fd:
+            fd.write(b'not a table')
+        self.assertIsNone(ratetable.get())
+        self.assertEqual(calculate('10', 'USD'), Decimal('15.00'))
+
+
+class SnapshotTest(TestCase):
+    "Test the last-known-good snapshot"
+    fixtures = ['currencies_test']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'currencies.json')
+        for name, value in (('SNAPSHOT', self.path), ('_snapshot', None), ('_stat', None), ('_retry_at', None)):
+            patcher = patch('currencies.snapshot.%s' % name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def database_down(self):
+        return patch('currencies.utils.get_active_currencies_qs', side_effect=OperationalError('down'))
+
+    def test_no_snapshot(self):
+        with self.database_down():
+            self.assertRaises(OperationalError, calculate, '10', 'USD')
+        self.assertIs(snapshot.stale(), False)
+
+    def test_fallback(self):
+        version = snapshot.write(Currency.objects.all())
+        self.assertEqual(snapshot.get().version, version)
+        self.assertIs(snapshot.stale(), False)
+        with self.database_down() as qs:
+            self.assertEqual(calculate('10', 'USD'), Decimal('15.00'))
+            self.assertIs(snapshot.stale(), True)
+            # The db is not retried until the retry period is over
+            with self.assertNumQueries(0):
+                self.assertEqual(calculate('10', 'USD'), Decimal('15.00'))
+            self.assertEqual(qs.call_count, 1)
+            self.assertRaises(Currency.DoesNotExist, calculate, '10', 'GBP')
+
+    def test_context(self):
+        "The context processor and currency_context tag serve the snapshot currencies"
+        snapshot.write(Currency.objects.all())
+        request = RequestFactory().get('/')
+        request.session = {}
+        with patch('currencies.managers.CurrencyManager.get_queryset', side_effect=OperationalError('down')):
+            context = curr_cp(request)
+            self.assertEqual((context['CURRENCY_CODE'], context['CURRENCY'].name), ('EUR', 'Euro'))
+            self.assertEqual([c.code for c in context['CURRENCIES']], ['EUR', 'USD'])
+            self.assertIs(context['CURRENCY_RATES_STALE'], True)
+            t = template.Template('{% load currency %}{% currency_context %}'
+                '{{ CURRENCY.code }} {% for c in CURRENCIES %}{{ c.code }}{% endfor %} {{ CURRENCY_RATES_STALE }}')
+            self.assertEqual(t.render(template.Context({'request': request})), 'EUR EURUSD True')
+
+    def test_revalidate(self):
+        snapshot.write(Currency.objects.all())
+        Currency.objects.filter(code='USD').update(factor=Decimal('2'))
+        with self.database_down(), patch('currencies.snapshot.SNAPSHOT_RETRY', 0):
+            self.assertEqual(calculate('10', 'USD'), Decimal('15.00'))
+        self.assertIs(snapshot.stale(), True)
+        self.assertEqual(calculate('10', 'USD'), Decimal('20.00'))
+        self.assertIs(snapshot.stale(), False)
+
+
+class AppConfigTest(TestCase):
+    "Test the app startup hooks"
+    fixtures = ['currencies_test']
+    databases = {'default', 'mirror'}
+
+    def test_preload(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'currencies.json')
+        snapshot.write(Currency.objects.all(), path)
+        with patch('currencies.snapshot.SNAPSHOT', path), patch('currencies.snapshot._snapshot', None), \
+                patch('currencies.snapshot._stat', None), patch('currencies.utils._exponents', {}) as exponents:
+            apps.get_app_config('currencies').preload()
+            self.assertEqual(snapshot._snapshot.default_code, 'EUR')
+            self.assertEqual(sorted(exponents), [0, 1, 2, 3, 4])
+
+    def test_check_default_currency(self):
+        self.assertEqual(check_default_currency(databases=['default']), [])
+        Currency.objects.update(is_default=False)
+        errors = check_default_currency(databases=['default', 'mirror'])
+        self.assertEqual([e.id for e in errors], ['currencies.W001'])
+        self.assertIn("'default'", errors[0].msg)
+
+    @override_settings(TEMPLATES=TEMPLATES_CTXPROC, SESSION_ENGINE='django.contrib.sessions.backends.db')
+    def test_check_settings(self):
+        with patch('currencies.conf.PRELOAD', True), patch('currencies.conf.SNAPSHOT', '/nonexistent/currencies.json'):
+            self.assertEqual([e.id for e in check_settings()],
+                             ['currencies.W002', 'currencies.W004'])
+        with patch('currencies.conf.PRELOAD', True):
+            self.assertEqual([e.id for e in check_settings()],
+                             ['currencies.W003', 'currencies.W004'])
+        with self.settings(SESSION_ENGINE='django.contrib.sessions.backends.cached_db'):
+            self.assertEqual(check_settings(), [])
+
+
+class ForeignKeyTest(TestCase):
+    "Test the CurrencyForeignKey"
+    fixtures = ['currencies_test']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'currencies.json')
+        for name, value in (('SNAPSHOT', self.path), ('_snapshot', None), ('_stat', None), ('_retry_at', None)):
+            patcher = patch('currencies.snapshot.%s' % name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        Product.objects.bulk_create([Product(price=1, currency_id=code) for code in ('EUR', 'USD', 'USD')])
+        self.products = Product.objects.order_by('pk')
+
+    def test_without_snapshot(self):
+        products = list(self.products)
+        with self.assertNumQueries(3):
+            self.assertEqual([p.currency.factor for p in products], [Decimal('1'), Decimal('1.5'), Decimal('1.5')])
+
+    def test_from_snapshot(self):
+        snapshot.write(Currency.objects.all())
+        products = list(self.products)
+        with self.assertNumQueries(0):
+            self.assertEqual([p.currency.factor for p in products], [Decimal('1'), Decimal('1.5'), Decimal('1.5')])
+            self.assertEqual(products[1].currency.name, 'US Dollar')
+        self.assertEqual(products[1].currency, Currency.objects.get(code='USD'))
+        # The info is not in the snapshot
+        with self.assertNumQueries(1):
+            self.assertEqual(products[1].currency.info, {})
+
+    def test_fallback(self):
+        "Currencies missing from the snapshot and stale snapshots come from the db"
+        Currency.objects.filter(code='USD').update(is_active=False)
+        snapshot.write(Currency.objects.all())
+        products = list(self.products)
+        with self.assertNumQueries(1):
+            self.assertIs(products[1].currency.is_active, False)
+            products[0].currency
+        product = self.products.all()[0]
+        with patch('currencies.fields.SNAPSHOT_MAX_AGE', 0):
+            with self.assertNumQueries(1):
+                product.currency
+
+    def test_max_age(self):
+        "A snapshot no longer refreshed is only trusted for a day by default"
+        snapshot.write(Currency.objects.all())
+        written = snapshot.get().written.timestamp()
+        fresh, stale = list(self.products)[:2]
+        with patch('currencies.fields.time.time', return_value=written + 60):
+            with self.assertNumQueries(0):
+                fresh.currency
+        with patch('currencies.fields.time.time', return_value=written + 24 * 60 * 60 + 1):
+            with self.assertNumQueries(1):
+                stale.currency
+
+    def test_migrations(self):
+        "Migrations see a plain ForeignKey"
+        call_command('makemigrations', 'tests', check=True, dry_run=True, verbosity=0)
+
+
+class ExpressionsTest(TestCase):
+    "Test the database conversion expressions"
+    fixtures = ['currencies_test']
+    use_transaction = False
+
+    def annotate(self, **kwargs):
+        return Currency.objects.annotate(price=Converted(**kwargs))
+
+    def test_converted_from_field(self):
+        qs = self.annotate(expression=Value(11), from_field='code', to='EUR')
+        self.assertEqual(qs.get(code='EUR').price, Decimal('11.00'))
+        self.assertEqual(qs.get(code='USD').price, Decimal('7.34'))
+
+    def test_converted_default_matches_calculate(self):
+        qs = self.annotate(expression=Value(Decimal('.5555')), to='USD', decimals=3)
+        self.assertEqual(qs.first().price, calculate('.5555', 'USD', decimals=3))
+
+    def test_converted_filter_order(self):
+        qs = self.annotate(expression=Value(10), from_field='code', to='USD')
+        self.assertEqual(list(qs.filter(price__lt=12).values_list('code', flat=True)), ['USD'])
+        self.assertEqual(list(qs.order_by('-price').values_list('code', flat=True)), ['EUR', 'USD'])
+
+    def test_converted_doesnotexist(self):
+        qs = self.annotate(expression=Value(10), to='GBP')
+        self.assertIsNone(qs.first().price)
+
+    def test_json_set(self):
+        self.assertTrue(JSONSet.supported(connection))
+        Currency.objects.filter(code='USD').update(info={'Keep': [1], 'RateUpdate': 'old'})
+        Currency.objects.filter(code='USD').update(
+            info=JSONSet('info', {'RateUpdate': 'new', 'Countries': ['US', 'EC'], 'Number': 840}))
+        self.assertEqual(Currency.objects.get(code='USD').info,
+            {'Keep': [1], 'RateUpdate': 'new', 'Countries': ['US', 'EC'], 'Number': 840})
+        self.assertRaises(ValueError, JSONSet, 'info', {'"': 1})
+
 
 class TemplateTagTest(TestCase):
     "Test the various template tag tools"
@@ -60,6 +547,119 @@ class TemplateTagTest(TestCase):
         )
         self.assertEqual(t.render(template.Context()), '15.00')
 
+    def test_show_currency(self):
+        "The tag renders with the converter of the render, the function keeps its signature"
+        t = template.Template(self.html +
+            '{% show_currency 10 "USD" %} {% show_currency 10 "USD" 0 as p %}{{ p }}')
+        with self.assertNumQueries(1):
+            self.assertEqual(t.render(template.Context()), '15.00 15')
+        self.assertEqual(show_currency(10, 'USD'), Decimal('15.00'))
+        self.assertEqual(show_currency('9.99', 'USD', decimals=0), Decimal('15'))
+
+    def test_currency_filter_types(self):
+        class Money(object):
+            def __init__(self, amount, currency):
+                self.amount, self.currency = amount, currency
+        t = template.Template(self.html + '{{ price|currency:"USD" }}')
+        for price in (Decimal('10'), 10, 10.0, '10', Money(Decimal('10'), 'EUR')):
+            self.assertEqual(t.render(template.Context({'price': price})), '15.00')
+        self.assertEqual(t.render(template.Context({'price': 9.99})), '14.99')
+        self.assertEqual(t.render(template.Context({'price': Money(Decimal('15'), 'USD')})), '15')
+        self.assertEqual(template.Template(self.html + '{{ price|currency:"EUR" }}').render(
+            template.Context({'price': Money(Decimal('15'), 'USD')})), '10.00')
+
+    def test_converter_per_render(self):
+        t = template.Template(self.html +
+            '{% for price in prices %}{% change_currency price "USD" %} {% show_currency price "USD" 0 %} {% endfor %}'
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(t.render(template.Context({'prices': [1, 2]})), '1.50 2 3.00 3 ')
+
+    def test_currencyblock(self):
+        t = template.Template(self.html +
+            '{% currencyblock to=code %}{% for price in prices %}<{% price price %}>{% endfor %}{% endcurrencyblock %}'
+            '{% currencyblock to="EUR" from="USD" decimals=0 %}{% price 15 %}{% endcurrencyblock %}'
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(t.render(template.Context({'code': 'USD', 'prices': [1, '2', 1]})),
+                '<1.50><3.00><1.50>10')
+
+    def test_currencyblock_nested(self):
+        t = template.Template(self.html +
+            '{% currencyblock to="USD" %}{% price 1 %} '
+            '{% currencyblock to="EUR" from="USD" %}{% price 3 %}{% endcurrencyblock %} '
+            '{% change_currency 2 "USD" %}{% endcurrencyblock %}'
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(t.render(template.Context()), '1.50 2.00 3.00')
+
+    def test_currency_cache_key_tag(self):
+        t = template.Template(self.html +
+            '{% currency_cache_key as key %}{{ key }} {% currency_cache_key "USD" %} '
+            '{% currency_cache_key CURRENCY_CODE %}'
+        )
+        with self.assertNumQueries(1):
+            output = t.render(template.Context({'CURRENCY_CODE': lambda: 'USD'}))
+        key = currency_cache_key('USD')
+        self.assertEqual(output, ' '.join([key] * 3))
+        self.assertEqual(template.Template(self.html + '{% currency_cache_key %}').render(
+            template.Context()), currency_cache_key('EUR'))
+
+    def test_currency_cache_key_fallback(self):
+        "Other source currencies are in the key, unknown ones or no default give a key rather than an error"
+        t = template.Template(self.html + '{% currency_cache_key code "USD" %}')
+        self.assertEqual(t.render(template.Context({'code': 'EUR'})), currency_cache_key('EUR', 'USD'))
+        self.assertNotEqual(currency_cache_key('EUR', 'USD'), currency_cache_key('EUR'))
+        self.assertEqual(t.render(template.Context({'code': 'GBP'})), 'GBP.none')
+        Currency.objects.filter(code='USD').update(is_active=False)
+        self.assertEqual(t.render(template.Context({'code': 'EUR'})), 'EUR.none')
+        Currency.objects.update(is_default=False)
+        t = template.Template(self.html + '{% currency_cache_key %}|{% currency_cache_key "EUR" %}')
+        self.assertEqual(t.render(template.Context()), 'None.none|EUR.none')
+
+    def test_currencyblock_failure(self):
+        self.assertRaises(template.TemplateSyntaxError, template.Template,
+            self.html + '{% currencyblock "USD" %}{% endcurrencyblock %}')
+        self.assertRaises(template.TemplateSyntaxError, template.Template,
+            self.html + '{% currencyblock to="USD" rate=1 %}{% endcurrencyblock %}')
+        self.assertRaises(template.TemplateSyntaxError, template.Template, self.html + '{% price 1 as %}')
+
+    def test_price(self):
+        "Outside a block, or assigned, the price is converted on its own"
+        t = template.Template(self.html +
+            '{% price 10 %} {% price 10 as p %}{{ p|floatformat:0 }} '
+            '{% currencyblock to="USD" decimals=3 %}{% price 1 as p %}{{ p|stringformat:"s"|slice:"3" }}{% endcurrencyblock %}'
+        )
+        self.assertEqual(t.render(template.Context({'CURRENCY_CODE': 'USD'})), '15.00 15 1.5')
+
+    def test_currencyblock_tags(self):
+        "The conversions of the other tags in a block are batched with its prices"
+        t = template.Template(self.html +
+            '{% currencyblock to="EUR" from="USD" %}{% price 3 %} {% show_currency 1 "USD" 0 %} '
+            '{% change_currency 2 "USD" %} {% show_currency 2 "USD" as p %}{{ p }}{% endcurrencyblock %}'
+        )
+        with patch.object(Converter, 'convert_many', autospec=True, side_effect=Converter.convert_many) as batch:
+            self.assertEqual(t.render(template.Context()), '2.00 2 3.00 3.00')
+        self.assertEqual(batch.call_count, 3)
+
+    def test_currencyblock_forged(self):
+        "Text which looks like a placeholder is not converted and never fails the page"
+        t = template.Template(self.html +
+            '{% currencyblock to="USD" %}{% price 1 %} {{ name }}{% endcurrencyblock %}')
+        for name in ('\x1a0:1:ZZZ::\x1a', '\x1a0:abc:::\x1a', '\x1a0:100:::0\x1a', '\x1a1:2:::\x1a'):
+            output = t.render(template.Context({'name': name}))
+            self.assertEqual(output, '1.50 ' + name.replace('\x1a', ''))
+
+    def test_currencyblock_cache(self):
+        "Placeholders cached in an earlier render are converted by the block of the current one"
+        t = template.Template(self.html + '{% load cache %}'
+            '{% currencyblock to=code %}{% cache 60 currencyblock_test %}{% price 1 %}{% endcache %}'
+            '|{% filter striptags %}<b>{% price 2 %}</b>{% endfilter %}{% endcurrencyblock %}'
+        )
+        self.addCleanup(caches['default'].clear)
+        self.assertEqual(t.render(template.Context({'code': 'USD'})), '1.50|3.00')
+        self.assertEqual(t.render(template.Context({'code': 'EUR'})), '1|2')
+
     def test_change_currency_tag_success(self):
         t = template.Template(self.html +
             '{% change_currency 10 "USD" %}'
@@ -73,6 +673,111 @@ class TemplateTagTest(TestCase):
         self.assertRaises(Currency.DoesNotExist, t.render, template.Context())
 
 
+class AsyncTest(TestCase):
+    "Test the async conversions, view and middleware"
+    fixtures = ['currencies_test']
+
+    def setUp(self):
+        conversions.clear()
+        self.addCleanup(conversions.clear)
+
+    async def test_acalculate(self):
+        self.assertEqual(await acalculate('10', 'USD'), Decimal('15.00'))
+        self.assertEqual(await acalculate('.5555', 'USD', decimals=3), Decimal('0.834'))
+        with self.assertRaises(Currency.DoesNotExist):
+            await acalculate('10', 'GBP')
+
+    async def test_aconvert(self):
+        self.assertEqual(await aconvert('15', 'USD', 'EUR', decimals=0), Decimal('10'))
+        self.assertEqual(await aconvert('15', 'USD', 'USD'), '15')
+
+    async def test_aget_currency_code(self):
+        request = AsyncRequestFactory().get('/')
+        self.assertEqual(await aget_currency_code(request), 'EUR')
+        request.COOKIES[SESSION_KEY] = 'USD'
+        self.assertEqual(await aget_currency_code(request), 'USD')
+        request.session = {SESSION_KEY: 'EUR'}
+        self.assertEqual(await aget_currency_code(request), 'EUR')
+
+    def test_rate_table(self):
+        "No queries with the rates in memory"
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with patch('currencies.ratetable.RATE_TABLE', os.path.join(tmpdir, 'rates.bin')):
+            ratetable.write(Currency.objects.all())
+            with self.assertNumQueries(0):
+                self.assertEqual(async_to_sync(acalculate)('10', 'USD'), Decimal('15.00'))
+                self.assertEqual(async_to_sync(aget_currency_code)(None), 'EUR')
+
+    async def test_aset_currency(self):
+        response = await self.async_client.post('/asetcurrency/', {'currency_code': 'USD'})
+        self.assertEqual((response.status_code, response['Location']), (302, '/'))
+        self.assertEqual(response.cookies[SESSION_KEY].value, 'USD')
+        self.assertIn('no-cache', response['Cache-Control'])
+        response = await self.async_client.post('/asetcurrency/', {'currency_code': 'GBP'})
+        self.assertNotIn(SESSION_KEY, response.cookies)
+
+    def test_middleware(self):
+        request = RequestFactory().get('/')
+        request.COOKIES[SESSION_KEY] = 'USD'
+        middleware = CurrencyMiddleware(lambda request: request.currency_code)
+        self.assertEqual(middleware(request), 'USD')
+
+        async def get_response(request):
+            return request.currency_code
+        middleware = CurrencyMiddleware(get_response)
+        self.assertTrue(iscoroutinefunction(middleware))
+        self.assertEqual(async_to_sync(middleware)(AsyncRequestFactory().get('/')), 'EUR')
+
+    def test_middleware_scope(self):
+        "The conversions of a request share one converter"
+        request = RequestFactory().get('/')
+        request.COOKIES[SESSION_KEY] = 'USD'
+        middleware = CurrencyMiddleware(lambda request: (calculate('10', 'USD'), convert('1', 'USD', 'EUR')))
+        with self.assertNumQueries(1):
+            self.assertEqual(middleware(request), (Decimal('15.00'), Decimal('0.67')))
+
+        async def get_response(request):
+            return await acalculate('10', 'USD'), await aconvert('1', 'USD', 'EUR')
+        middleware = CurrencyMiddleware(get_response)
+        with self.assertNumQueries(1):
+            self.assertEqual(async_to_sync(middleware)(request), (Decimal('15.00'), Decimal('0.67')))
+
+
+class MetricsTest(TestCase):
+    "Test the instrumentation layer"
+    fixtures = ['currencies_test']
+    use_transaction = False
+
+    def setUp(self):
+        self.sink = metrics.PrometheusSink()
+        metrics.configure([self.sink])
+
+    def tearDown(self):
+        metrics.configure([])
+
+    def test_disabled(self):
+        metrics.configure([])
+        self.assertIs(metrics.timer('test'), metrics.queries('test'))
+        calculate('10', 'USD')
+        self.assertEqual(self.sink.values, {})
+
+    def test_conversions_and_queries(self):
+        calculate('10', 'USD')
+        template.Template('{% load currency %}{{ 10|currency:"USD" }}').render(template.Context())
+        output = self.sink.render()
+        self.assertIn('currencies_conversions_total{function="calculate"} 1', output)
+        self.assertIn('currencies_conversions_total{function="convert"} 2', output)
+        self.assertIn('currencies_template_renders_total{tag="currency"} 1', output)
+        self.assertIn('currencies_template_queries_total{tag="currency"} 1', output)
+
+    def test_prometheus_view(self):
+        Currency.objects.filter(code='USD').update(rate_updated=datetime.fromtimestamp(1543773606))
+        response = metrics.prometheus_view(RequestFactory().get('/metrics'))
+        self.assertContains(response, '# TYPE currencies_rate_timestamp_seconds gauge')
+        self.assertContains(response, 'currencies_rate_timestamp_seconds{code="USD"} 1543773606')
+
+
 class ContextTest(TestCase):
     """
     Test the two methods of retrieving currency context in a template
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Import-time regression checks using `python -X importtime`
+The web facing modules must never pull in the HTTP, XML or HTML parsing
+machinery that only the management command sources need
+"""
+from __future__ import unicode_literals
+import os
+import sys
+import json
+import subprocess
+from unittest import TestCase, skipUnless
+
+
+# Modules imported by web workers
+WEB_MODULES = [
+    'currencies.utils',
+    'currencies.context_processors',
+    'currencies.views',
+    'currencies.urls',
+    'currencies.templatetags.currency',
+    'currencies.expressions',
+    'currencies.metrics',
+]
+
+# Only the sources may import these
+FORBIDDEN = ('requests', 'urllib3', 'bs4', 'xml.etree', 'xml.dom', 'xml.sax')
+
+# Opt-in cumulative budget for importing WEB_MODULES after django.setup(), e.g. 250000.
+# Wall clock timings are not reliable on shared runners, so it is not checked by default
+BUDGET_US = int(os.environ.get('CURRENCIES_IMPORT_BUDGET_US', 0))
+
+SCRIPT = """
+import sys, json
+from django.conf import settings
+settings.configure(
+    INSTALLED_APPS=['django.contrib.contenttypes', 'currencies'],
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+    ROOT_URLCONF='currencies.urls',
+)
+import django
+django.setup()
+sys.stderr.write('--- setup done\\n')
+before = set(sys.modules)
+for name in %r:
+    __import__(name)
+print(json.dumps(sorted(set(sys.modules) - before)))
+"""
+
+
+def importtime(modules):
+    """Returns the modules newly imported and the -X importtime lines for importing them"""
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', SCRIPT % (modules,)],
+        cwd=root, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    lines = proc.stderr.split('--- setup done\n', 1)[1].splitlines()
+    return json.loads(proc.stdout), [line for line in lines if line.startswith('import time:')]
+
+
+def cumulative(lines):
+    """Sum the cumulative microseconds of the top level imports"""
+    total = 0
+    for line in lines:
+        _, cumul, name = line.split('|')
+        if not name[1:].startswith(' '):
+            total += int(cumul)
+    return total
+
+
+class ImportTest(TestCase):
+    "Test what importing the package costs"
+
+    def assertNoForbidden(self, new_modules):
+        found = [name for name in new_modules if name.startswith(FORBIDDEN)]
+        self.assertEqual(found, [])
+
+    def test_web_modules(self):
+        new_modules, lines = importtime(WEB_MODULES)
+        self.assertNoForbidden(new_modules)
+
+    @skipUnless(BUDGET_US, "set CURRENCIES_IMPORT_BUDGET_US to check the import time")
+    def test_web_modules_budget(self):
+        new_modules, lines = importtime(WEB_MODULES)
+        self.assertLess(cumulative(lines), BUDGET_US)
+
+    def test_commands(self):
+        "The commands import their sources on demand"
+        new_modules, lines = importtime([
+            'currencies.management.commands.currencies',
+            'currencies.management.commands.updatecurrencies',
+        ])
+        self.assertNoForbidden(new_modules)
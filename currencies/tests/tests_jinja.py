@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+The Jinja2 extension, and a product listing against the Django template tags:
+both must give the same output for the same number of queries. Set
+CURRENCIES_JINJA_PARITY_RATIO to also benchmark that Jinja2 is no slower
+"""
+from __future__ import unicode_literals
+import os
+import timeit
+from decimal import Decimal
+from unittest import skipIf, skipUnless
+
+from django import template
+from django.test import TestCase, RequestFactory
+
+from currencies.models import Currency
+from currencies.conf import SESSION_KEY
+from currencies.utils import conversions, currency_cache_key
+
+try:
+    import jinja2
+    from currencies.jinja import CurrencyExtension
+except ImportError:
+    jinja2 = None
+
+
+# Opt-in, the slowest the Jinja2 listing may be compared to the Django one, e.g. 1.5.
+# Wall clock timings are not reliable on shared runners, so it is not checked by default
+PARITY_RATIO = float(os.environ.get('CURRENCIES_JINJA_PARITY_RATIO', 0))
+
+DJANGO_LISTING = (
+    '{% load currency %}{% for price in prices %}{% show_currency price code %} {% endfor %}')
+JINJA_LISTING = (
+    '{% for price in prices %}{{ price|currency(code) }} {% endfor %}')
+
+
+@skipIf(jinja2 is None, "jinja2 is not installed")
+class JinjaTest(TestCase):
+    "Test the Jinja2 extension"
+    fixtures = ['currencies_test']
+
+    def setUp(self):
+        self.env = jinja2.Environment(extensions=[CurrencyExtension])
+        conversions.clear()
+        self.addCleanup(conversions.clear)
+
+    def render(self, source, **context):
+        return self.env.from_string(source).render(**context)
+
+    def test_filter(self):
+        self.assertEqual(self.render('{{ 10|currency("USD") }}'), '15.00')
+        self.assertEqual(self.render('{{ "0.5555"|currency("USD", 3) }}'), '0.834')
+        self.assertRaises(Currency.DoesNotExist, self.render, '{{ 10|currency("GBP") }}')
+
+    def test_convert(self):
+        self.assertEqual(self.render('{{ convert(15, "USD", "EUR", 0) }}'), '10')
+
+    def test_currency_cache_key(self):
+        self.assertEqual(self.render('{{ currency_cache_key("USD") }}'), currency_cache_key('USD'))
+        self.assertEqual(self.render('{{ currency_cache_key() }}', CURRENCY_CODE='USD'), currency_cache_key('USD'))
+        request = RequestFactory().get('/')
+        request.session = {SESSION_KEY: 'USD'}
+        self.assertEqual(self.render('{{ currency_cache_key() }}', request=request), currency_cache_key('USD'))
+        self.assertEqual(self.render('{{ currency_cache_key(none, "USD") }}'), currency_cache_key('EUR', 'USD'))
+        self.assertEqual(self.render('{{ currency_cache_key("GBP") }}'), 'GBP.none')
+
+    def test_converter_per_render(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.render(JINJA_LISTING + '{{ convert(3, "USD", "EUR") }}',
+                prices=[1, 2], code='USD'), '1.50 3.00 2.00')
+
+    def test_currency_context(self):
+        request = RequestFactory().get('/')
+        request.session = {SESSION_KEY: 'USD'}
+        source = ('{% set c = currency_context() %}'
+                  '{{ c.CURRENCY_CODE }} {{ c.CURRENCY.name }} {{ c.CURRENCIES|length }} {{ c.CURRENCY_RATES_STALE }}')
+        self.assertEqual(self.render(source, request=request), 'USD US Dollar 2 False')
+        request.session = {}
+        self.assertEqual(self.render(source, request=request), 'EUR Euro 2 False')
+
+    def listing(self):
+        context = {'prices': [Decimal(i) / 4 for i in range(100)] * 5, 'code': 'USD'}
+        django_template = template.Template(DJANGO_LISTING)
+        jinja_template = self.env.from_string(JINJA_LISTING)
+        return (lambda: django_template.render(template.Context(context)),
+                lambda: jinja_template.render(**context))
+
+    def test_parity(self):
+        "The listing, Jinja2 against the Django tags"
+        django_render, jinja_render = self.listing()
+        with self.assertNumQueries(1):
+            expected = django_render()
+        with self.assertNumQueries(1):
+            self.assertEqual(jinja_render(), expected)
+
+    @skipUnless(PARITY_RATIO, "set CURRENCIES_JINJA_PARITY_RATIO to benchmark the listing")
+    def test_parity_benchmark(self):
+        "The listing benchmark, Jinja2 against the Django tags"
+        django_render, jinja_render = self.listing()
+        django_time = min(timeit.repeat(django_render, number=5, repeat=3))
+        jinja_time = min(timeit.repeat(jinja_render, number=5, repeat=3))
+        self.assertLess(jinja_time, django_time * PARITY_RATIO)
@@ -4,6 +4,7 @@ Various test cases for the `currencies` and `updatecurrencies` management comman
 """
 from __future__ import unicode_literals
 import re, os, sys
+import json, pstats, tempfile
 from decimal import Decimal
 from datetime import datetime, timedelta
 from functools import wraps
@@ -15,11 +16,19 @@ else:
     from mock import patch, MagicMock
 
 from django import template
+from django.db import connection
 from django.test import TestCase, override_settings
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
 from django.core.management import call_command
 from django.core.exceptions import ImproperlyConfigured
 from currencies.models import Currency
-from currencies.utils import calculate
+from currencies.utils import calculate, _QueryRates
+from currencies.signals import RateChange, rates_updated
+from currencies import ratetable, snapshot
+from currencies.management.commands._currencyhandler import BaseHandler
+from currencies.management.commands._europeancentralbank import CurrencyHandler as ECBHandler
+from currencies.management.commands._currencyiso import CurrencyHandler as ISOHandler
 
 
 cwd = os.path.abspath(os.path.dirname(__file__))
@@ -594,3 +603,276 @@ class ISOTest(IncInfoMixin, IncCacheMixin, BaseTestMixin, TestCase):
     fixtures = ['currencies_test']
     source_arg = ('iso',)
 
+
+
+# Run offline from the cached daily feed
+@patch('currencies.management.commands._europeancentralbank.get', mock_requestget_exception())
+class ECBTest(TestCase):
+    "Test European Central Bank support"
+    fixtures = ['currencies_test']
+    source_arg = ('ecb',)
+
+    run_cmd_verify_stdout = BaseTestMixin.run_cmd_verify_stdout
+
+    def test_timings(self):
+        "Currencies: phase timings and machine-readable summary"
+        output = self.run_cmd_verify_stdout(3, 'currencies', '--timings', '-i=GBP')
+        summary = [line for line in output if line.startswith('currencies-timings ')]
+        self.assertEqual(len(summary), 1)
+        summary = json.loads(summary[0].split(' ', 1)[1])
+        self.assertEqual(summary['command'], 'currencies')
+        self.assertGreater(summary['phases']['write']['queries'], 0)
+        self.assertGreater(summary['phases']['diff']['queries'], 0)
+
+    def test_profile(self):
+        "Currencies: cProfile stats dumped to file"
+        with tempfile.NamedTemporaryFile(suffix='.pstats') as fd:
+            self.run_cmd_verify_stdout(2, 'currencies', '--profile=' + fd.name, '-i=GBP')
+            self.assertTrue(pstats.Stats(fd.name).total_calls)
+
+    def test_import_currency(self):
+        "Currencies: import from the cached feed"
+        self.run_cmd_verify_stdout(2, 'currencies', '-i=GBP')
+        record = Currency.objects.get(code='GBP')
+        self.assertEqual(record.name, 'Pound sterling')
+        self.assertEqual(record.symbol, '£')
+
+    def test_update_rates(self):
+        "Rates: EUR based rates from the cached feed"
+        self.run_cmd_verify_stdout(2, 'updatecurrencies')
+        usd = Currency.objects.get(code='USD')
+        self.assertEqual(usd.factor, Decimal('1.0866'))
+        self.assertEqual(usd.info['RateUpdate'], '2024-10-18T00:00:00')
+        self.assertEqual((usd.rate_updated, usd.rate_source), (datetime(2024, 10, 18), 'ecb'))
+
+    def test_rates_updated(self):
+        "Rates: one signal per run with the changes and the new rates version"
+        calls = []
+        receiver = lambda **kwargs: calls.append(kwargs)
+        rates_updated.connect(receiver)
+        self.addCleanup(rates_updated.disconnect, receiver)
+        self.run_cmd_verify_stdout(2, 'updatecurrencies')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0]['changes'],
+            {'USD': RateChange(Decimal('1.5'), Decimal('1.0866'), datetime(2024, 10, 18))})
+        self.assertEqual((calls[0]['source'], calls[0]['using']), ('ecb', 'default'))
+        self.assertEqual(calls[0]['version'], _QueryRates(Currency.active.all()).version)
+        self.assertEqual((calls[0]['table_version'], calls[0]['snapshot_version']), (None, None))
+        # Nothing changed, nothing sent
+        self.run_cmd_verify_stdout(2, 'updatecurrencies')
+        self.assertEqual(len(calls), 1)
+
+    def test_update_rates_info(self):
+        "Rates: the info keys are set by the db, or the whole document is written"
+        Currency.objects.filter(code='USD').update(info={'Keep': 1})
+        with CaptureQueriesContext(connection) as ctx:
+            self.run_cmd_verify_stdout(2, 'updatecurrencies')
+        self.assertTrue(any('JSON_SET' in query['sql'] for query in ctx.captured_queries))
+        info = Currency.objects.get(code='USD').info
+        self.assertEqual((info['Keep'], info['RateUpdate']), (1, '2024-10-18T00:00:00'))
+
+        Currency.objects.filter(code='USD').update(factor=Decimal(1), info={'Keep': 2})
+        with patch('currencies.expressions.JSONSet.vendors', ()):
+            with CaptureQueriesContext(connection) as ctx:
+                self.run_cmd_verify_stdout(2, 'updatecurrencies')
+        self.assertFalse(any('JSON_SET' in query['sql'] for query in ctx.captured_queries))
+        info = Currency.objects.get(code='USD').info
+        self.assertEqual((info['Keep'], info['RateUpdate']), (2, '2024-10-18T00:00:00'))
+
+    def test_update_rates_specifybase(self):
+        "Rates: changing base away from EUR"
+        self.run_cmd_verify_stdout(3, 'updatecurrencies', '--base=USD')
+        self.assertEqual(Currency.objects.get(code='EUR').factor, Decimal('0.9203018590'))
+        self.assertEqual(Currency.objects.get(code='USD', is_base=True).factor, Decimal('1'))
+
+    @patch('currencies.management.commands._currencyhandler.RATE_PRECISION', 14)
+    def test_update_rates_precision(self):
+        "Rates: factors are rounded as stored, an unchanged rate is not written again"
+        self.run_cmd_verify_stdout(2, 'updatecurrencies', '--base=USD')
+        self.assertEqual(Currency.objects.get(code='EUR').factor, Decimal('0.9203018590'))
+        output = self.run_cmd_verify_stdout(2, 'updatecurrencies', '--base=USD')
+        self.assertFalse([line for line in output if line.startswith('Updating')])
+
+    @override_settings(CURRENCY_RATE_THRESHOLD='0.05%')
+    def test_update_rates_threshold(self):
+        "Rates: changes below the threshold are not written"
+        Currency.objects.filter(code='USD').update(factor=Decimal('1.0865'))
+        output = self.run_cmd_verify_stdout(2, 'updatecurrencies')
+        self.assertIn("Suppressed 1 rate updates below the change threshold", output)
+        self.assertEqual(Currency.objects.get(code='USD').factor, Decimal('1.0865'))
+        with self.settings(CURRENCY_RATE_THRESHOLDS={'USD': '0.0001'}):
+            self.run_cmd_verify_stdout(2, 'updatecurrencies')
+        self.assertEqual(Currency.objects.get(code='USD').factor, Decimal('1.0866'))
+
+    @override_settings(CURRENCY_RATE_THRESHOLD='0.05%', CURRENCY_RATE_MAX_AGE=3600)
+    def test_update_rates_max_age(self):
+        "Rates: stale rates are written whatever the threshold"
+        modified = (datetime.now() - timedelta(seconds=60)).isoformat()
+        Currency.objects.filter(code='USD').update(factor=Decimal('1.0865'), info={'RateModified': modified})
+        self.run_cmd_verify_stdout(2, 'updatecurrencies')
+        self.assertEqual(Currency.objects.get(code='USD').factor, Decimal('1.0865'))
+        modified = (datetime.now() - timedelta(seconds=3601)).isoformat()
+        Currency.objects.filter(code='USD').update(info={'RateModified': modified})
+        self.run_cmd_verify_stdout(2, 'updatecurrencies')
+        usd = Currency.objects.get(code='USD')
+        self.assertEqual(usd.factor, Decimal('1.0866'))
+        self.assertGreater(usd.info['RateModified'], modified)
+
+    @override_settings(CURRENCY_RATE_THRESHOLD='0.05%', CURRENCY_RATE_MAX_AGE=3600)
+    def test_update_rates_max_age_timezones(self):
+        "Rates: timestamps written with or without USE_TZ compare with the current setting"
+        naive = datetime.now() - timedelta(seconds=3601)
+        for use_tz, modified in ((True, naive), (False, timezone.make_aware(naive))):
+            Currency.objects.filter(code='USD').update(factor=Decimal('1.0865'), info={'RateModified': modified.isoformat()})
+            with self.settings(USE_TZ=use_tz):
+                self.run_cmd_verify_stdout(2, 'updatecurrencies')
+            self.assertEqual(Currency.objects.get(code='USD').factor, Decimal('1.0866'))
+
+    @override_settings(CURRENCY_RATE_THRESHOLD='1.2.3%')
+    def test_update_rates_invalid_threshold(self):
+        "Rates: invalid threshold setting"
+        self.assertRaises(ImproperlyConfigured, self.run_cmd_verify_stdout, 2, 'updatecurrencies')
+
+    def test_update_rates_table(self):
+        "Rates: the rate table is published"
+        with tempfile.NamedTemporaryFile() as fd, patch('currencies.ratetable.RATE_TABLE', fd.name):
+            self.run_cmd_verify_stdout(2, 'updatecurrencies')
+            self.assertEqual(ratetable.get().factor('USD'), Decimal('1.0866'))
+
+    def test_update_rates_snapshot(self):
+        "Rates: the snapshot is saved, its version is sent apart from the rates version"
+        calls = []
+        receiver = lambda **kwargs: calls.append(kwargs)
+        rates_updated.connect(receiver)
+        self.addCleanup(rates_updated.disconnect, receiver)
+        with tempfile.NamedTemporaryFile() as fd, patch('currencies.snapshot.SNAPSHOT', fd.name):
+            self.run_cmd_verify_stdout(2, 'updatecurrencies')
+            saved = snapshot.load(fd.name)
+            self.assertEqual(saved.factor('USD'), Decimal('1.0866'))
+        self.assertEqual(calls[0]['snapshot_version'], saved.version)
+        self.assertEqual(calls[0]['version'], _QueryRates(Currency.active.all()).version)
+
+    def test_rebase(self):
+        "Rates: one exact rebase of the whole table"
+        handler = ECBHandler(lambda *args, **kwargs: None)
+        rates = handler.rebase(handler.rates, 'EUR', 'USD')
+        self.assertEqual(len(rates), 31)
+        self.assertEqual(rates['USD'], Decimal(1))
+        self.assertEqual(rates['IDR'], Decimal('15472.0504325419'))
+        self.assertEqual(handler.rebase(handler.rates, 'EUR', 'USD', precision=2)['IDR'], Decimal('15472.05'))
+        self.assertEqual(len(handler._reciprocals), 1)
+        self.assertEqual(handler.ratechangebase(handler.rates['IDR'], 'EUR', 'USD'), rates['IDR'])
+        self.assertRaises(RuntimeError, handler.rebase, handler.rates, 'EUR', 'ZZZ')
+
+    def test_iter_rates(self):
+        "Rates: the feed is streamed day by day"
+        rates = list(ECBHandler(lambda *args, **kwargs: None).iter_rates())
+        self.assertEqual(len(rates), 30)
+        self.assertEqual(rates[0], (datetime(2024, 10, 18), 'USD', Decimal('1.0866')))
+
+    @override_settings(CURRENCY_ECB_FEED='hist')
+    def test_no_connectivity_or_cache(self):
+        "Currencies: no history feed cached and no connection"
+        self.assertRaises(RuntimeError, self.run_cmd_verify_stdout, 2, 'currencies', '-i=GBP')
+
+    @override_settings(CURRENCY_ECB_FEED='weekly')
+    def test_invalid_feed(self):
+        "Rates: unknown feed setting"
+        self.assertRaises(ImproperlyConfigured, self.run_cmd_verify_stdout, 2, 'updatecurrencies')
+
+
+class HandlerProtocolTest(TestCase):
+    "Test the handler protocol versions"
+
+    def get_handler(self, protocol, **attrs):
+        attrs.update(name='Test', endpoint='', protocol=protocol)
+        return type(str('CurrencyHandler'), (BaseHandler,), attrs)(lambda *args, **kwargs: None)
+
+    def test_protocol1_supports(self):
+        "Protocol 1 capabilities are found from the methods"
+        handler = self.get_handler(1, get_ratefactor=lambda self, base, code: Decimal(1))
+        self.assertIs(handler.supports('rates'), True)
+        self.assertIs(handler.supports('timestamps'), False)
+        self.assertIs(handler.supports('info'), False)
+
+    def test_protocol2_supports(self):
+        "Protocol 2 capabilities are declared"
+        handler = self.get_handler(2, capabilities=frozenset(['info']),
+            get_ratefactor=lambda self, base, code: Decimal(1))
+        self.assertIs(handler.supports('rates'), False)
+        self.assertIs(handler.supports('info'), True)
+
+    def test_protocol1_adapter(self):
+        "The bulk rates adapter skips the missing codes, like protocol 2"
+        rates = {'EUR': Decimal(1), 'USD': Decimal('1.1')}
+        def get_ratefactor(self, base, code):
+            if code not in rates:
+                raise RuntimeError("%s not found" % code)
+            return rates[code]
+        ts = datetime(2024, 1, 1)
+        handler = self.get_handler(1, get_ratefactor=get_ratefactor,
+            get_ratetimestamp=lambda self, base, code: ts)
+        self.assertEqual(handler.get_ratefactors('EUR', ['USD', 'GBP', 'EUR']),
+            {'USD': (Decimal('1.1'), ts), 'EUR': (Decimal(1), ts)})
+
+    @patch('currencies.management.commands._europeancentralbank.get', mock_requestget_exception())
+    def test_protocol2_bulk(self):
+        "Bulk rates omit the missing codes"
+        handler = ECBHandler(lambda *args, **kwargs: None)
+        self.assertEqual(handler.get_ratefactors('EUR', ['USD', 'KWD', 'EUR']), {
+            'USD': (Decimal('1.0866'), datetime(2024, 10, 18)),
+            'EUR': (Decimal(1), datetime(2024, 10, 18)),
+        })
+
+    def test_bulk_metadata_adapter(self):
+        "The bulk metadata adapter uses the per code methods"
+        handler = self.get_handler(1, get_currencyname=lambda self, code: code.lower(),
+            get_info=lambda self, code: {'Code': code})
+        self.assertEqual(handler.get_bulk_metadata(['GBP']),
+            {'GBP': {'name': 'gbp', 'symbol': '£', 'info': {'Code': 'GBP'}}})
+
+    @patch('currencies.management.commands._currencyiso.get', mock_requestget_exception())
+    def test_bulk_metadata_iso(self):
+        "ISO metadata matches the per code methods"
+        handler = ISOHandler(lambda *args, **kwargs: None)
+        codes = ['USD', 'KWD', 'EUR']
+        metadata = handler.get_bulk_metadata(codes + ['ZZZ'])
+        self.assertEqual(sorted(metadata), sorted(codes))
+        for code in codes:
+            self.assertEqual(metadata[code], {
+                'name': handler.get_currencyname(code),
+                'symbol': handler.get_currencysymbol(code),
+                'info': handler.get_info(code),
+            })
+
+
+@patch('currencies.management.commands._europeancentralbank.get', mock_requestget_exception())
+class DatabaseTest(TestCase):
+    "Test multiple database support"
+    databases = {'default', 'mirror'}
+    fixtures = ['currencies_test']
+
+    def test_update_database(self):
+        "Rates: only the chosen database is updated"
+        call_command('updatecurrencies', 'ecb', database='mirror', stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(Currency.objects.using('mirror').get(code='USD').factor, Decimal('1.0866'))
+        self.assertEqual(Currency.objects.get(code='USD').factor, Decimal('1.5'))
+
+    def test_import_database(self):
+        "Currencies: only the chosen database is updated"
+        call_command('currencies', 'ecb', '-i=GBP', database='mirror', stdout=StringIO(), stderr=StringIO())
+        self.assertTrue(Currency.objects.using('mirror').filter(code='GBP').exists())
+        self.assertFalse(Currency.objects.filter(code='GBP').exists())
+
+    @override_settings(DATABASE_ROUTERS=['currencies.routers.CurrencyRouter'])
+    @patch('currencies.routers.READ_DATABASE', 'mirror')
+    def test_router(self):
+        "Reads are routed to the read database and writes to the write database"
+        Currency.objects.using('mirror').filter(code='USD').update(factor=Decimal('2'))
+        self.assertEqual(calculate(10, 'USD'), Decimal('20.00'))
+        self.assertEqual(Currency.active.all().db, 'mirror')
+        self.assertEqual(Currency.objects.all().db, 'mirror')
+        with patch('currencies.routers.WRITE_DATABASE', 'mirror'):
+            call_command('updatecurrencies', 'ecb', stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(Currency.objects.using('mirror').get(code='USD').factor, Decimal('1.0866'))
+        self.assertEqual(Currency.objects.using('default').get(code='USD').factor, Decimal('1.5'))
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Test cases for the optional precomputed price table
+"""
+from __future__ import unicode_literals
+from decimal import Decimal
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from currencies.models import Currency
+from currencies.prices import registry
+from currencies.prices.models import ConvertedPrice
+from currencies.signals import RateChange, rates_updated
+from currencies.tests.models import Product
+
+
+class PricesTest(TestCase):
+    "Test the registered model price table"
+    fixtures = ['currencies_test']
+
+    def setUp(self):
+        registry.register(Product, 'price', from_field='currency')
+        self.eur = Product.objects.create(price=Decimal('10'), currency_id='EUR')
+        self.usd = Product.objects.create(price=Decimal('30'), currency_id='USD')
+
+    def tearDown(self):
+        registry.unregister(Product, 'price')
+
+    def price(self, product, code):
+        return ConvertedPrice.objects.get(object_id=str(product.pk), currency=code).amount
+
+    def test_saved_objects_are_priced(self):
+        self.assertEqual(self.price(self.eur, 'USD'), Decimal('15.00'))
+        self.assertEqual(self.price(self.usd, 'EUR'), Decimal('20.00'))
+        self.assertEqual(ConvertedPrice.objects.count(), 4)
+
+    def test_deleted_objects_are_removed(self):
+        self.eur.delete()
+        self.assertEqual(ConvertedPrice.objects.count(), 2)
+
+    def test_refresh_changed_currency(self):
+        Currency.objects.filter(code='USD').update(factor=Decimal('2'))
+        # USD column for everything plus every column of USD priced products
+        self.assertEqual(registry.refresh(['USD']), 3)
+        self.assertEqual(self.price(self.eur, 'USD'), Decimal('20.00'))
+        self.assertEqual(self.price(self.usd, 'EUR'), Decimal('15.00'))
+
+    def test_rates_updated(self):
+        Currency.objects.filter(code='USD').update(factor=Decimal('2'))
+        rates_updated.send(sender=None, changes={'USD': RateChange(Decimal('1.5'), Decimal('2'), None)},
+            version='1', source='oxr', using='default')
+        self.assertEqual(self.price(self.eur, 'USD'), Decimal('20.00'))
+
+    def test_refresh_all(self):
+        ConvertedPrice.objects.all().delete()
+        self.assertEqual(registry.refresh(chunk_size=1), 4)
+        self.assertEqual(self.price(self.usd, 'USD'), Decimal('30.00'))
+
+    def test_refresh_all_inactive(self):
+        "A full refresh removes the prices in currencies deactivated since"
+        Currency.objects.filter(code='USD').update(is_active=False)
+        registry.refresh()
+        self.assertFalse(ConvertedPrice.objects.filter(currency='USD').exists())
+        self.assertEqual(registry.annotate_price(Product.objects.all(), 'USD')[0].price_usd, None)
+
+    def test_default_changed(self):
+        "Prices converted from the default currency follow a new default"
+        registry.register(Product, 'price')
+        self.eur.save()
+        self.assertEqual(self.price(self.eur, 'EUR'), Decimal('10.00'))
+        with self.captureOnCommitCallbacks(execute=True):
+            Currency.objects.set_default('USD')
+        self.assertEqual(self.price(self.eur, 'EUR'), Decimal('6.67'))
+        eur = Currency.objects.get(code='EUR')
+        eur.is_default = True
+        with self.captureOnCommitCallbacks(execute=True):
+            eur.save()
+        self.assertEqual(self.price(self.eur, 'EUR'), Decimal('10.00'))
+
+    def test_annotate_price(self):
+        qs = registry.annotate_price(Product.objects.all(), 'EUR').order_by('price_eur')
+        self.assertEqual([p.price_eur for p in qs], [Decimal('10.00'), Decimal('20.00')])
+
+    def test_migrations(self):
+        "The primary key does not follow DEFAULT_AUTO_FIELD, the migrations are complete"
+        call_command('makemigrations', 'currencies_prices', check=True, dry_run=True, verbosity=0)
@@ -1,33 +1,308 @@
 # -*- coding: utf-8 -*-
+import contextvars
+import hashlib
+from contextlib import contextmanager
 from decimal import Decimal as D, InvalidOperation, ROUND_UP
+from asgiref.sync import sync_to_async
+from django.db import DatabaseError, router
+from django.db.models import Q
+from django.utils.functional import cached_property
 from .models import Currency as C
-from .conf import SESSION_KEY
+from .conf import SESSION_KEY, CONVERSION_CACHE_SIZE
+from .lru import LRUCache
+from . import metrics, ratetable, snapshot
+
+
+# Recent conversion results, see conversions.info() for the hit rate
+conversions = LRUCache('conversions', CONVERSION_CACHE_SIZE)
 
 
 def get_active_currencies_qs():
-    return C.active.defer('info').all()
+    # The info is loaded when used, the typed columns hold what is usually needed
+    return C.active.defer('info')
+
+
+def rates_source():
+    """The rate table, or the snapshot standing in for the db, or None to query the db"""
+    table = ratetable.get()
+    if table is not None:
+        return table
+    return snapshot.serving()
+
+
+def _unavailable(error):
+    """The snapshot to use on a db error, re-raises the error if there is none"""
+    source = snapshot.unavailable()
+    if source is None:
+        raise error
+    return source
+
+
+def get_active_currencies():
+    """
+    The active currencies, read now so that a db error falls back to the snapshot
+    here rather than while rendering. A list of the snapshot currencies in that case
+    """
+    source = snapshot.serving()
+    if source is None:
+        try:
+            qs = C.active.all()
+            len(qs)
+            return qs
+        except DatabaseError as e:
+            source = _unavailable(e)
+    return source.instances(C, router.db_for_read(C))
+
+
+def get_currency(code):
+    """The active currency of a code in any case or None, from the snapshot while the db is unavailable"""
+    source = snapshot.serving()
+    if source is None:
+        try:
+            return C.active.filter(code__iexact=code).first()
+        except DatabaseError as e:
+            source = _unavailable(e)
+    return source.instance(C, (code or '').upper(), router.db_for_read(C))
+
+
+class _QueryRates(object):
+    """The factors of the currencies of a queryset, read in one query"""
+    fields = ('code', 'factor', 'is_default')
+
+    def __init__(self, qs=None, rows=None):
+        self.factors = {}
+        self.default_code = None
+        for code, factor, is_default in rows if qs is None else qs.values_list(*self.fields):
+            self.factors[code] = factor
+            if is_default:
+                self.default_code = code
+
+    @cached_property
+    def version(self):
+        """A hash of the factors, computed once when first needed"""
+        return hashlib.sha1(repr(sorted(self.factors.items())).encode('utf-8')).hexdigest()
+
+    @classmethod
+    async def aload(cls, qs):
+        """Read with the async ORM"""
+        return cls(rows=[row async for row in qs.values_list(*cls.fields)])
+
+    def factor(self, code):
+        return self.factors[code]
+
+
+def price_currency(price):
+    """The currency code of a Money-like price with amount and currency attributes, else None"""
+    currency = getattr(price, 'currency', None)
+    if currency is not None and hasattr(price, 'amount'):
+        return getattr(currency, 'code', currency)
+    return None
+
+
+def to_decimal(price):
+    """
+    Returns (Decimal amount, currency code or None) of a price given as a Decimal, int,
+    float, string or a Money-like object with amount and currency attributes
+    """
+    code = price_currency(price)
+    if code is not None:
+        price = price.amount
+    if isinstance(price, D):
+        return price, code
+    if isinstance(price, float):
+        # As formatted, like the string it would have been rendered as
+        return D(repr(price)), code
+    return D(price), code
+
+
+def _rates_qs(qs, codes):
+    if qs is None:
+        qs = get_active_currencies_qs()
+        codes = [code for code in codes or () if code]
+        if codes:
+            qs = qs.filter(Q(code__in=codes) | Q(is_default=True))
+    return qs
+
+
+class Converter(object):
+    """
+    Converts any number of prices with the rates resolved once: from the rate table,
+    the snapshot standing in for the db, or one query of the active currencies,
+    only of codes and the default currency if given.
+    Results are cached by amount, codes, decimals and the version of the rates
+    """
+
+    def __init__(self, qs=None, source=None, codes=None):
+        if source is None and qs is None:
+            source = rates_source()
+        if source is None:
+            try:
+                source = _QueryRates(_rates_qs(qs, codes))
+            except DatabaseError as e:
+                source = _unavailable(e)
+        self.source = source
+
+    @classmethod
+    async def acreate(cls, qs=None, codes=None):
+        """A converter with the rates read by the async ORM, if not already in memory"""
+        source = rates_source() if qs is None else None
+        if source is None:
+            try:
+                source = await _QueryRates.aload(_rates_qs(qs, codes))
+            except DatabaseError as e:
+                source = _unavailable(e)
+        return cls(source=source)
+
+    @property
+    def default_code(self):
+        return self.source.default_code
+
+    def factor(self, code):
+        try:
+            return self.source.factor(code)
+        except KeyError:
+            raise C.DoesNotExist("Currency %s not found in the %s" % (code, self.source.__class__.__name__))
+
+    def convert(self, price, to_code, from_code=None, decimals=2):
+        """
+        Converts a price to another currency from its own currency if Money-like,
+        otherwise from from_code or the default currency
+        """
+        if metrics.enabled:
+            metrics.incr('currencies_conversions_total', function='convert')
+        amount, code = to_decimal(price)
+        from_code = code or from_code or self.default_code
+        if from_code is None:
+            raise C.DoesNotExist("No default currency in the %s" % self.source.__class__.__name__)
+        if from_code == to_code:
+            return amount if code else price
+
+        key = (amount, from_code, to_code, decimals, self.source.version)
+        result = conversions.get(key)
+        if result is None:
+            from_factor, to_factor = self.factor(from_code), self.factor(to_code)
+            result = price_rounding(amount * (to_factor / from_factor), decimals=decimals)
+            conversions.set(key, result)
+        return result
+
+    def convert_many(self, prices, to_code, from_code=None, decimals=2):
+        """Converts a batch of prices to one currency, returning a list. Each distinct price is converted once"""
+        done = {}
+        results = []
+        for price in prices:
+            amount, code = to_decimal(price)
+            # As formatted, equal amounts such as 10 and 10.0 render differently
+            key = (str(amount), code or from_code)
+            try:
+                result = done[key]
+            except KeyError:
+                result = done[key] = self.convert(price, to_code, from_code, decimals)
+            results.append(result)
+        return results
+
+
+# The converters shared by the current request, see request_scope()
+_scope = contextvars.ContextVar('currencies_scope', default=None)
+
+
+@contextmanager
+def request_scope():
+    """
+    Shares one converter between the conversions of the block, e.g. of one request
+    as entered by CurrencyMiddleware, so that the rates are resolved once
+    """
+    token = _scope.set({})
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def request_converter():
+    """The converter of the current request_scope(), created when first used, or None outside one"""
+    scope = _scope.get()
+    if scope is None:
+        return None
+    if Converter not in scope:
+        scope[Converter] = Converter()
+    return scope[Converter]
+
+
+async def arequest_converter():
+    """request_converter() for async code"""
+    scope = _scope.get()
+    if scope is None:
+        return None
+    if Converter not in scope:
+        scope[Converter] = await Converter.acreate()
+    return scope[Converter]
+
+
+def converter_for(*codes, qs=None):
+    """
+    The converter of the current request, or else a converter of qs, or of only the
+    codes and the default currency unless the rates are in memory
+    """
+    converter = request_converter() if qs is None else None
+    return converter or Converter(qs, codes=codes)
 
 
 def calculate(price, to_code, **kwargs):
     """Converts a price in the default currency to another currency"""
-    qs = kwargs.get('qs', get_active_currencies_qs())
-    kwargs['qs'] = qs
-    default_code = qs.default().code
-    return convert(price, default_code, to_code, **kwargs)
+    if metrics.enabled:
+        metrics.incr('currencies_conversions_total', function='calculate')
+    qs = kwargs.pop('qs', None)
+    return converter_for(to_code, price_currency(price), qs=qs).convert(price, to_code, **kwargs)
 
 
 def convert(amount, from_code, to_code, decimals=2, qs=None):
     """Converts from any currency to any currency"""
     if from_code == to_code:
+        if metrics.enabled:
+            metrics.incr('currencies_conversions_total', function='convert')
         return amount
+    return converter_for(from_code, to_code, price_currency(amount), qs=qs).convert(
+        amount, to_code, from_code, decimals)
 
-    if qs is None:
-        qs = get_active_currencies_qs()
 
-    from_, to = qs.get(code=from_code), qs.get(code=to_code)
+async def aconverter_for(*codes, qs=None):
+    """converter_for() for async code, the rates are read with the async ORM if not in memory"""
+    converter = await arequest_converter() if qs is None else None
+    return converter or await Converter.acreate(qs, codes=codes)
+
+
+async def acalculate(price, to_code, **kwargs):
+    """calculate() for async code"""
+    if metrics.enabled:
+        metrics.incr('currencies_conversions_total', function='calculate')
+    qs = kwargs.pop('qs', None)
+    return (await aconverter_for(to_code, price_currency(price), qs=qs)).convert(price, to_code, **kwargs)
+
+
+async def aconvert(amount, from_code, to_code, decimals=2, qs=None):
+    """convert() for async code"""
+    if from_code == to_code:
+        if metrics.enabled:
+            metrics.incr('currencies_conversions_total', function='convert')
+        return amount
+    return (await aconverter_for(from_code, to_code, price_currency(amount), qs=qs)).convert(
+        amount, to_code, from_code, decimals)
+
 
-    amount = D(amount) * (to.factor / from_.factor)
-    return price_rounding(amount, decimals=decimals)
+def rate_version(code, *codes, converter=None):
+    """
+    A short version of the rate of a currency: it changes with the factors of that
+    currency and of the default currency only, unlike the version of all the rates.
+    Pass the codes of the other currencies the prices are converted from, if any
+    """
+    converter = converter or converter_for(code, *codes)
+    factors = '/'.join(str(converter.factor(c).normalize()) for c in (code, converter.default_code) + codes)
+    return hashlib.sha1(factors.encode('ascii')).hexdigest()[:12]
+
+
+def currency_cache_key(code, *codes, converter=None):
+    """A fragment cache key component for prices in a currency, e.g. 'USD.1f0e3dad9990'"""
+    return '%s.%s' % (code, rate_version(code, *codes, converter=converter))
 
 
 def get_currency_code(request):
@@ -39,17 +314,63 @@ def get_currency_code(request):
                 continue
 
     # fallback to default...
+    source = rates_source()
+    if source is not None:
+        return source.default_code
     try:
         return C.active.default().code
     except C.DoesNotExist:
         return None  # shit happens...
+    except DatabaseError as e:
+        return _unavailable(e).default_code
 
 
-def price_rounding(price, decimals=2):
-    """Takes a decimal price and rounds to a number of decimal places"""
+async def aget_currency_code(request):
+    """get_currency_code() for async code"""
+    session = getattr(request, 'session', None)
+    if session is not None:
+        # Sessions are only async on Django 5+, loading one may otherwise hit the db
+        aget = getattr(session, 'aget', None)
+        code = await (aget(SESSION_KEY) if aget else sync_to_async(session.get)(SESSION_KEY))
+        if code is not None:
+            return code
+    if hasattr(request, 'COOKIES') and SESSION_KEY in request.COOKIES:
+        return request.COOKIES[SESSION_KEY]
+
+    source = rates_source()
+    if source is not None:
+        return source.default_code
+    try:
+        return (await C.active.adefault()).code
+    except C.DoesNotExist:
+        return None
+    except DatabaseError as e:
+        return _unavailable(e).default_code
+
+
+# Quantize exponents by number of decimal places, ex. JPY and HUF have none
+_exponents = {}
+
+
+def build_exponents(max_decimals=4):
+    """Build the common rounding exponents in advance"""
+    for decimals in range(max_decimals + 1):
+        _exponent(decimals)
+
+
+def _exponent(decimals):
+    try:
+        return _exponents[decimals]
+    except KeyError:
+        pass
     try:
         exponent = D('.' + decimals * '0')
     except InvalidOperation:
         # Currencies with no decimal places, ex. JPY, HUF
         exponent = D()
-    return price.quantize(exponent, rounding=ROUND_UP)
+    return _exponents.setdefault(decimals, exponent)
+
+
+def price_rounding(price, decimals=2):
+    """Takes a decimal price and rounds to a number of decimal places"""
+    return price.quantize(_exponent(decimals), rounding=ROUND_UP)
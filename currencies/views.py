@@ -3,10 +3,13 @@
 from django import VERSION
 from django.utils.http import url_has_allowed_host_and_scheme
 from django.http import HttpResponseRedirect
+from django.utils.cache import add_never_cache_headers
 from django.views.decorators.cache import never_cache
+from asgiref.sync import sync_to_async
 
 from .models import Currency
 from .conf import SESSION_KEY
+from .utils import rates_source
 
 
 def _is_safe_url(url, allowed_hosts, **kwargs):
@@ -17,8 +20,8 @@ def _is_safe_url(url, allowed_hosts, **kwargs):
         return url_has_allowed_host_and_scheme(url, allowed_hosts=allowed_hosts, **kwargs)
 
 
-@never_cache
-def set_currency(request):
+def _redirect(request):
+    """The currency code requested and the redirect to the next page"""
     next, currency_code = (
         request.POST.get('next') or request.GET.get('next'),
         request.POST.get('currency_code', None) or
@@ -29,10 +32,47 @@ def set_currency(request):
         if not _is_safe_url(next, [request.get_host()]):
             next = '/'
 
-    response = HttpResponseRedirect(next)
-    if currency_code and Currency.active.filter(code=currency_code).exists():
-        # Set cookie irrespective for page cache visibility
-        response.set_cookie(SESSION_KEY, currency_code)
-        if hasattr(request, 'session'):
-            request.session[SESSION_KEY] = currency_code
+    return currency_code, HttpResponseRedirect(next)
+
+
+def _is_active(currency_code):
+    """Checked in memory when the rate table or snapshot is in use, else None"""
+    source = rates_source()
+    if source is not None:
+        return currency_code in source
+    return None
+
+
+@never_cache
+def set_currency(request):
+    currency_code, response = _redirect(request)
+    if currency_code:
+        is_active = _is_active(currency_code)
+        if is_active is None:
+            is_active = Currency.active.filter(code=currency_code).exists()
+        if is_active:
+            # Set cookie irrespective for page cache visibility
+            response.set_cookie(SESSION_KEY, currency_code)
+            if hasattr(request, 'session'):
+                request.session[SESSION_KEY] = currency_code
+    return response
+
+
+async def aset_currency(request):
+    """set_currency as an async view for ASGI deployments, never_cache is sync only before Django 5"""
+    currency_code, response = _redirect(request)
+    if currency_code:
+        is_active = _is_active(currency_code)
+        if is_active is None:
+            is_active = await Currency.active.filter(code=currency_code).aexists()
+        if is_active:
+            response.set_cookie(SESSION_KEY, currency_code)
+            if hasattr(request, 'session'):
+                # Sessions are only async on Django 5+
+                aset = getattr(request.session, 'aset', None)
+                if aset:
+                    await aset(SESSION_KEY, currency_code)
+                else:
+                    await sync_to_async(request.session.__setitem__)(SESSION_KEY, currency_code)
+    add_never_cache_headers(response)
     return response
@@ -24,7 +24,12 @@ if not settings.configured:
             'default': {
                 'ENGINE': 'django.db.backends.sqlite3',
                 'NAME': ':memory:'
-            }
+            },
+            # A local mirror for the multiple database tests
+            'mirror': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': ':memory:'
+            },
         },
         TEMPLATES = [
             {
@@ -41,6 +46,8 @@ if not settings.configured:
             'django.contrib.sessions',
             'django.contrib.sites',
             'currencies',
+            'currencies.prices',
+            'currencies.tests',
         ),
         # For django 1.8 to 2.1 compatibility
         MIDDLEWARE = MIDDLEWARE,
@@ -53,10 +53,14 @@ setup(
     license='BSD License',
 
     install_requires=[
-        'django>=3.1',
+        'django>=4.1',  # the async ORM
+        'asgiref>=3.6',
         'requests>=2.14.2',
         'beautifulsoup4',
     ],
+    extras_require={
+        'jinja2': ['Jinja2>=3.0'],
+    },
 
     description='Adds support for multiple currencies as a Django application.',
     long_description_content_type='text/x-rst',
@@ -86,18 +90,15 @@ setup(
         'Development Status :: 5 - Production/Stable',
         'Environment :: Web Environment',
         'Framework :: Django',
-        'Framework :: Django :: 3.1',
-        'Framework :: Django :: 3.2',
-        'Framework :: Django :: 4.0',
+        'Framework :: Django :: 4.1',
+        'Framework :: Django :: 4.2',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: BSD License',
         'Operating System :: OS Independent',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
-        'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
         'Programming Language :: Python :: 3.9',
         'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Topic :: Internet :: WWW/HTTP',
         'Topic :: Internet :: WWW/HTTP :: Dynamic Content',
     ],